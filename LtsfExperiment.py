@@ -1,4 +1,6 @@
 # MY_CW_MAIN.py
+import os
+
 import numpy as np
 from cw2.cw_data.cw_wandb_logger import WandBLogger
 
@@ -8,7 +10,7 @@ from cw2 import experiment, cw_error
 from cw2.cw_data import cw_logging
 from torch import optim, nn
 
-from data_provider.data_factory import data_provider
+from data_provider.data_factory import data_provider, data_splits
 from exp.exp_main import Exp_Main
 from utils.metrics import MSE
 from utils.tools import dotdict
@@ -20,10 +22,14 @@ class LtsfExperiment(experiment.AbstractIterativeExperiment):
 
         params = cw_config['params']
         params['iterations'] = cw_config['iterations']
+        if params.get('checkpoints') in (None, 'None'):  # checkpoints in the log directory of the repetition
+            params['checkpoints'] = cw_config.get('_rep_log_path') or os.path.join(
+                cw_config.get('log_path', cw_config['path']), f"rep_{rep:02d}")
 
         self.config = dotdict(params)
         self.expMain = Exp_Main(self.config)
 
+        self.data_splits = data_splits(self.config)  # read once for all splits
         self.train_data, self.train_loader = self._get_data(flag='train')
         # self.vali_data, self.vali_loader = self._get_data(flag='val')
         self.test_data, self.test_loader = self._get_data(flag='test')
@@ -31,19 +37,32 @@ class LtsfExperiment(experiment.AbstractIterativeExperiment):
         self.criterion = self._select_criterion()
         self.model_optim = self._select_optimizer()
 
+        # resume after the last checkpointed epoch, e.g. when a preempted job is restarted
+        epoch = self.expMain.load_checkpoint(model_optim=self.model_optim, required=False)
+        self.start_iteration = 0 if epoch is None else epoch + 1
+        if self.start_iteration > 0:
+            cw_logging.getLogger().info(f"Resuming repetition {rep} at epoch {self.start_iteration}")
+
     def iterate(self, cw_config: dict, rep: int, n: int) -> dict:
-        train_loss, trues_preds_train = self.expMain.train(n, train_data=self.train_data,
-                                                           train_loader=self.train_loader,
-                                                           criterion=self.criterion,
-                                                           model_optim=self.model_optim)  # train step
-        # vali_loss, trues_preds_vali = self.expMain.vali(vali_data=self.vali_data, vali_loader=self.vali_loader,
-        #                                                 criterion=self.criterion)  # vali
-        test_loss, trues_preds_test = self.expMain.vali(vali_data=self.test_data, vali_loader=self.test_loader,
-                                                        criterion=self.criterion)  # test
+        if n < self.start_iteration:  # finished before the restart
+            return {'iter': n, 'resumed': True}
+
+        train_loss, trues_preds_train, train_metrics = self.expMain.train(n, train_data=self.train_data,
+                                                                          train_loader=self.train_loader,
+                                                                          criterion=self.criterion,
+                                                                          model_optim=self.model_optim)  # train step
+        # vali_loss, trues_preds_vali, vali_metrics = self.expMain.vali(vali_data=self.vali_data,
+        #                                                               vali_loader=self.vali_loader,
+        #                                                               criterion=self.criterion)  # vali
+        test_loss, trues_preds_test, test_metrics = self.expMain.vali(vali_data=self.test_data,
+                                                                      vali_loader=self.test_loader,
+                                                                      criterion=self.criterion)  # test
 
         cw_logging.getLogger().info(
             f"epoch: {n} | train loss: {train_loss} | test loss: {test_loss}")
         results = {"test_loss": test_loss, "train_loss": train_loss, 'iter': n}
+        results.update({f"train_{k}": v for k, v in train_metrics.items()})
+        results.update({f"test_{k}": v for k, v in test_metrics.items()})
 
         # log results as diagrams
         if n + 1 == cw_config['iterations']:
@@ -95,7 +114,12 @@ class LtsfExperiment(experiment.AbstractIterativeExperiment):
         cw_logging.getLogger().info(f"Finished saving diagrams {title} in wandb!")
 
     def save_state(self, cw_config: dict, rep: int, n: int) -> None:
-        pass
+        if n < self.start_iteration:
+            return
+
+        checkpoint_freq = self.config.checkpoint_freq or 1
+        if (n + 1) % checkpoint_freq == 0 or n + 1 == cw_config['iterations']:
+            self.expMain.save_checkpoint(n, self.model_optim)
 
     def finalize(self, surrender: cw_error.ExperimentSurrender = None, crash: bool = False):
         if surrender is not None:
@@ -107,7 +131,7 @@ class LtsfExperiment(experiment.AbstractIterativeExperiment):
             return
 
     def _get_data(self, flag):
-        data_set, data_loader = data_provider(self.config, flag)
+        data_set, data_loader = data_provider(self.config, flag, splits=self.data_splits)
         return data_set, data_loader
 
     def _select_optimizer(self):
@@ -2,8 +2,9 @@ import torch
 from torch.nn.utils.rnn import pad_sequence
 
 from data_provider.data_loader import Dataset_ETT_hour, Dataset_ETT_minute, Dataset_Custom, Dataset_Pred, \
-    Dataset_Traffic_Even
-from torch.utils.data import DataLoader
+    Dataset_Traffic_Even, TrafficEvenSplits
+from data_provider.sampler import ChunkShuffleSampler
+from torch.utils.data import BatchSampler, DataLoader, RandomSampler, SequentialSampler
 
 data_dict = {
     'ETTh1': Dataset_ETT_hour,
@@ -15,7 +16,21 @@ data_dict = {
 }
 
 
-def data_provider(args, flag, collate_fn=None):
+def data_splits(args):
+    # shared by the data_provider calls of one experiment so that the data is only read and split once
+    if data_dict[args.data] is not Dataset_Traffic_Even:
+        return None
+
+    return TrafficEvenSplits(
+        root_path=args.root_path,
+        data_path=args.data_path,
+        size=[args.seq_len, args.label_len, args.pred_len],
+        transform=args.transform,
+        smooth_param=args.smooth_param
+    )
+
+
+def data_provider(args, flag, collate_fn=None, splits=None):
     Data = data_dict[args.data]
     timeenc = 0 if args.embed != 'timeF' else 1
 
@@ -47,9 +62,29 @@ def data_provider(args, flag, collate_fn=None):
         freq=freq,
         stride=args.seq_stride,
         transform=args.transform,
-        smooth_param=args.smooth_param
+        smooth_param=args.smooth_param,
+        cache_path=args.cache_path,
+        splits=splits
     )
     print(flag, len(data_set))
+    if hasattr(data_set, 'get_batch') and collate_fn is None:
+        # the dataset gathers whole batches itself, the loader only converts them to tensors
+        if shuffle_flag and args.shuffle_chunk_size:
+            # shuffles chunks of consecutive windows - fewer random reads of memory mapped flows
+            sampler = ChunkShuffleSampler(data_set, chunk_size=args.shuffle_chunk_size,
+                                          buffer_chunks=args.shuffle_buffer_chunks or 16)
+        elif shuffle_flag:
+            sampler = RandomSampler(data_set)
+        else:
+            sampler = SequentialSampler(data_set)
+        data_loader = DataLoader(
+            data_set,
+            batch_size=None,
+            sampler=BatchSampler(sampler, batch_size=batch_size, drop_last=drop_last),
+            num_workers=args.num_workers
+        )
+        return data_set, data_loader
+
     data_loader = DataLoader(
         data_set,
         batch_size=batch_size,
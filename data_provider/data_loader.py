@@ -1,31 +1,118 @@
 import ast
+import hashlib
 import itertools
-import pickle
+import json
 import random
+import shutil
 
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import pandas as pd
 import os
 
-from scipy.ndimage import gaussian_filter1d, convolve
-from scipy.signal import stft
 from torch.utils.data import Dataset
 from sklearn.preprocessing import StandardScaler
 
-from utils.data_preparation_tools import split_by
-from utils.scaler import  StandardScalerList
-from utils.timefeatures import time_features
+from utils.data_preparation_tools import split_by, split_counts
+from utils.scaler import  StandardScalerList, inverse_transform_array
+from utils.sequence_store import META_DTYPE, SequenceStore, is_sequence_store, load_sequences, source_version
+from utils.smoothing import SMOOTHING_TRANSFORMS, smooth_sequences
+from utils.stft_store import open_stft_store
+from utils.timefeatures import calendar_marks, local_datetime64, time_features, time_marks
 import warnings
 
-from utils.tools import ema_smoothing
-
 warnings.filterwarnings('ignore')
 
 
+class TrafficEvenSplits:
+    """Processed flows of Dataset_Traffic_Even read, smoothed and split once for the train, val and test datasets.
+    The datasets only keep views of the flow buffer and the scaler fitted on train of one TrafficEvenSplits.
+    """
+
+    def __init__(self, root_path, data_path, size, scale=True, transform=None, smooth_param=None):
+        self.root_path = root_path
+        self.data_path = data_path
+        self.seq_len = size[0]
+        self.pred_len = size[2]
+        self.scale = scale
+        self.transform = transform
+        self.smooth_param = smooth_param
+        self.data = None  # read on first use, cached datasets do not need it
+
+    def borders(self, set_type):
+        if self.data is None:
+            self.__read_data__()
+        return self.split_borders[set_type]
+
+    def __read_data__(self):
+        # memory mapped sequence store or pickled list[list] - smoothed flows are prepared once and kept on disk
+        if self.transform in SMOOTHING_TRANSFORMS:
+            data_raw = smooth_sequences(os.path.join(self.root_path, self.data_path), self.transform,
+                                        self.smooth_param)
+        else:
+            data_raw = load_sequences(os.path.join(self.root_path, self.data_path))
+
+        print(f"[+] Loaded {len(data_raw)} flows.")
+
+        counts = []  # windows per flow
+        flows = []  # index of the flow in data_raw
+
+        data_stamps = []
+        data = []
+
+        for i in range(len(data_raw)):
+            if len(data_raw[i][1]) < self.seq_len + self.pred_len:
+                continue
+
+            data_stamp, data_bytes_flow = data_raw[i]
+            data_bytes_flow = data_bytes_flow.reshape(-1, 1)
+
+            counts.append(len(data_bytes_flow) - self.seq_len - self.pred_len)
+            flows.append(i)
+
+            data.append(data_bytes_flow)
+            data_stamps.append(data_stamp)
+
+            if i % 1000 == 0:
+                print(f"[+] Finished loading {i / len(data_raw)} flows.")
+
+        print(f"[+] Found {sum([len(x) for x in data])} sequences in {len(data_raw)} flows.")
+
+        assert len(data_stamps) == len(data)
+
+        split_borders = split_counts(counts, [0.7, 0.1, 0.2])
+        assert len(split_borders) == 3
+        self.split_borders = split_borders
+
+        self.scaler = StandardScalerList()
+        if self.scale:
+            # only fitted here - the windows are scaled in __getitem__ so the flows can stay memory mapped
+            train_data = data[split_borders[0][0]:split_borders[0][1]]
+            self.scaler.fit(train_data)
+
+        # all flows in one buffer, flow f starts at flow_starts[f]
+        self.flows = np.array(flows, dtype=np.int64)
+        if isinstance(data_raw, SequenceStore):
+            self.buffer = data_raw.values  # the flows are views of the mapped values of the store
+            self.flow_starts = data_raw.offsets[flows]
+            self.store_path = data_raw.path
+        else:
+            self.store_path = None
+            self.buffer = np.concatenate(data, axis=0, dtype=np.float32)
+            self.flow_starts = np.zeros(len(data), dtype=np.int64)
+            self.flow_starts[1:] = np.cumsum([len(x) for x in data])[:-1]
+            data = [self.buffer[s:s + len(x)] for s, x in zip(self.flow_starts, data)]
+
+        self.counts = counts
+        self.data_stamps = data_stamps
+        self.data = data
+
+
 class Dataset_Traffic_Even(Dataset):
     def __init__(self, root_path, flag='train', size=None,
                  features='S', data_path='univ1_pt1_even.csv',
-                 target='OT', scale=True, timeenc=0, freq='h', stride=100, transform=None, smooth_param=None):
+                 target='OT', scale=True, timeenc=0, freq='h', stride=100, transform=None, smooth_param=None,
+                 cache_path=None, splits=None):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -52,76 +139,172 @@ class Dataset_Traffic_Even(Dataset):
 
         self.root_path = root_path
         self.data_path = data_path
+        self.cache_path = cache_path
+        self.splits = splits  # shared TrafficEvenSplits of the train, val and test datasets
         self.__read_data__()
 
     def __read_data__(self):
         self.scaler = StandardScalerList()
 
-        with open(os.path.join(self.root_path, self.data_path), 'rb') as f:
-            data_raw: list[list] = pickle.load(f)  # returns list[list]
-
-        print(f"[+] Loaded {len(data_raw)} flows.")
-
-        indexes = []  # sequences
+        cache = self._cache_dir()
+        if cache is not None and os.path.isdir(cache) and not self._cache_valid(cache):
+            print(f"[+] Removing stale dataset cache {cache} ...")
+            shutil.rmtree(cache, ignore_errors=True)
 
-        data_stamps = []
-        data = []
-
-        for i in range(len(data_raw)):
-            if len(data_raw[i][0]) < self.seq_len + self.pred_len:
-                continue
-
-            data_stamp = data_raw[i][0]
-            data_bytes_flow = data_raw[i][1].reshape(-1, 1)
-
-            if self.transform == 'gaussian':
-                data_bytes_flow = gaussian_filter1d(data_bytes_flow.reshape(-1), sigma=self.smooth_param,
-                                                    mode="nearest").reshape(-1, 1)
-
-            if self.transform == 'uniform':
-                kernel = np.array([1 / self.smooth_param for _ in range(-((self.smooth_param - 1) // 2),
-                                                                        ((self.smooth_param - 1) // 2))])
-                data_bytes_flow = convolve(data_bytes_flow.reshape(-1), weights=kernel, mode="constant",
-                                           cval=0.0).reshape(-1, 1)
-
-            if self.transform == 'ema':
-                data_bytes_flow = ema_smoothing(data_bytes_flow.reshape(-1), a=self.smooth_param).reshape(-1, 1)
-
-            indexes.append([[len(data), j] for j in range(len(data_bytes_flow) - self.seq_len - self.pred_len)])
-
-            data.append(data_bytes_flow)
-            data_stamps.append(data_stamp)
-
-            if i % 1000 == 0:
-                print(f"[+] Finished loading {i / len(data_raw)} flows.")
-
-        print(f"[+] Found {sum([len(x) for x in data])} sequences in {len(data_raw)} flows.")
+        if cache is not None and os.path.isdir(cache):
+            self._load_cache(cache)
+        else:
+            self._build_data()
+            if cache is not None:
+                self._save_cache(cache)
 
-        assert len(data_stamps) == len(data)
+        if all(isinstance(x, tuple) for x in self.data_stamp_x):
+            self.flow_times = np.array([local_datetime64(x[0]) for x in self.data_stamp_x], dtype='datetime64[us]')
+            self.flow_aggrs = np.array([x[1] for x in self.data_stamp_x], dtype=np.int64)
+        else:
+            self.flow_times = None  # time marks of every step (older processed files)
 
-        splitted_index = split_by(indexes, [0.7, 0.1, 0.2])
-        assert len(splitted_index) == 3
-        border1s = [splitted_index[i][0][0][0] for i in range(len(splitted_index))]
-        border2s = [splitted_index[i][-1][0][0] + 1 for i in
-                    range(len(splitted_index))]  # +1 because we also want the content of the key
-        self.border1 = border1s[self.set_type]
-        self.border2 = border2s[self.set_type]
+    def _build_data(self):
+        splits = self.splits
+        if splits is None:
+            splits = TrafficEvenSplits(self.root_path, self.data_path, [self.seq_len, self.label_len, self.pred_len],
+                                       scale=self.scale, transform=self.transform, smooth_param=self.smooth_param)
 
+        self.border1, self.border2 = splits.borders(self.set_type)
         if self.scale:
-            train_data = data[border1s[0]:border2s[0]]
-            self.scaler.fit(train_data)
-            data = self.scaler.transform(data)
+            self.scaler = splits.scaler
+
+        self.data_x = splits.data[self.border1: self.border2]
+        self.data_y = self.data_x
+        self.data_stamp_x = splits.data_stamps[self.border1: self.border2]
+        self.data_stamp_y = self.data_stamp_x
+        # window j of the split is window j - window_offsets[f] of flow f, only every stride-th window is used
+        self.window_offsets = np.zeros(self.border2 - self.border1 + 1, dtype=np.int64)
+        self.window_offsets[1:] = np.cumsum(splits.counts[self.border1: self.border2])
+
+        # buffer of all flows for get_batch, flow f of the split starts at flow_starts[f]
+        self.buffer = splits.buffer
+        self.flow_starts = splits.flow_starts[self.border1: self.border2]
+        self.store_path = splits.store_path  # sequence store of the buffer, None if it is in memory
+        self.flows = splits.flows[self.border1: self.border2]
+
+    def _cache_dir(self):
+        # one cache entry per data file version and configuration of the split - the version of a sequence store
+        # are the mtimes and sizes of its files, as they are rewritten in place
+        if self.cache_path is None or self.cache_path == 'None':
+            return None
+
+        data_file = os.path.join(self.root_path, self.data_path)
+        key = repr((os.path.abspath(data_file), source_version(data_file), self.seq_len, self.pred_len,
+                    self.stride, self.transform, self.smooth_param, self.scale, self.set_type))
+        return os.path.join(self.root_path, self.cache_path, hashlib.sha1(key.encode()).hexdigest())
+
+    @staticmethod
+    def _cache_valid(cache):
+        # entries of sequence stores reference the (e.g. smoothed) store, which has to be unchanged
+        source_file = os.path.join(cache, 'source.json')
+        if not os.path.isfile(source_file):
+            return os.path.isfile(os.path.join(cache, 'buffer.npy'))
+
+        with open(source_file) as f:
+            source = json.load(f)
+        return is_sequence_store(source['path']) and \
+            json.loads(json.dumps(source_version(source['path']))) == source['version']
+
+    def _save_cache(self, cache):
+        if not all(isinstance(x, tuple) for x in self.data_stamp_x):
+            print("[+] Not caching the dataset, the time marks of older processed files are not supported.")
+            return
+
+        # written next to the final directory and renamed, so parallel jobs never see a partial cache
+        tmp = f"{cache}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+
+        if self.store_path is not None:  # flows of the store, the values stay memory mapped from the store
+            np.save(os.path.join(tmp, 'flows.npy'), self.flows)
+            with open(os.path.join(tmp, 'source.json'), 'w') as f:
+                json.dump({'path': os.path.abspath(self.store_path), 'version': source_version(self.store_path)}, f)
+        else:
+            np.save(os.path.join(tmp, 'buffer.npy'), np.concatenate(self.data_x, axis=0))
+            np.save(os.path.join(tmp, 'lengths.npy'), np.array([len(x) for x in self.data_x], dtype=np.int64))
+            np.save(os.path.join(tmp, 'meta.npy'), np.array(self.data_stamp_x, dtype=META_DTYPE))
+        np.save(os.path.join(tmp, 'window_offsets.npy'), self.window_offsets)
+        np.save(os.path.join(tmp, 'borders.npy'), np.array([self.border1, self.border2], dtype=np.int64))
+        if self.scale:
+            self.scaler.save(os.path.join(tmp, 'scaler.npz'))
+
+        try:
+            os.rename(tmp, cache)
+            print(f"[+] Saved dataset cache in {cache}.")
+        except OSError:  # written by another job in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _load_cache(self, cache):
+        print(f"[+] Opening dataset cache with location: {cache} ...")
+
+        if os.path.isfile(os.path.join(cache, 'source.json')):
+            with open(os.path.join(cache, 'source.json')) as f:
+                store = SequenceStore(json.load(f)['path'])
+            self.store_path = store.path
+            self.flows = np.load(os.path.join(cache, 'flows.npy'))
+            self.buffer = store.values
+            self.flow_starts = store.offsets[self.flows]
+            lengths = store.lengths[self.flows]
+            meta = store.meta[self.flows]
+        else:
+            self.store_path = None
+            self.buffer = np.load(os.path.join(cache, 'buffer.npy'), mmap_mode='r')
+            lengths = np.load(os.path.join(cache, 'lengths.npy'))
+            self.flow_starts = np.zeros(len(lengths), dtype=np.int64)
+            self.flow_starts[1:] = np.cumsum(lengths)[:-1]
+            meta = np.load(os.path.join(cache, 'meta.npy'))
+
+        self.window_offsets = np.load(os.path.join(cache, 'window_offsets.npy'))
+        self.border1, self.border2 = np.load(os.path.join(cache, 'borders.npy')).tolist()
+        if self.scale:
+            self.scaler.load(os.path.join(cache, 'scaler.npz'))
+
+        self.data_x = [self.buffer[s:s + n] for s, n in zip(self.flow_starts.tolist(), lengths.tolist())]
+        self.data_y = self.data_x
+        self.data_stamp_x = list(zip(meta['start'].tolist(), meta['aggr'].tolist()))
+        self.data_stamp_y = self.data_stamp_x
+
+    def _window(self, index):
+        # (flow, offset) of the index-th used window
+        window = index * self.stride
+        flow = int(np.searchsorted(self.window_offsets, window, side='right')) - 1
+        return flow, int(window - self.window_offsets[flow])
+
+    def get_batch(self, indices):
+        """All windows of a batch at once - stacked seq_x, seq_y, seq_x_mark, seq_y_mark like __getitem__"""
+        windows = np.asarray(indices, dtype=np.int64) * self.stride
+        flows = np.searchsorted(self.window_offsets, windows, side='right') - 1
+        begins = windows - self.window_offsets[flows]
+
+        length = self.seq_len + self.pred_len
+        view = sliding_window_view(self.buffer, length, axis=0)  # [n - length + 1, features, length]
+        seq = view[self.flow_starts[flows] + begins].transpose(0, 2, 1)
+        if self.scale:
+            seq = self.scaler.transform_array(seq, dtype=np.float32)
+        else:
+            seq = seq.astype(np.float32, copy=False)
 
-        self.data_x = data[self.border1: self.border2]
-        self.data_y = data[self.border1: self.border2]
-        self.data_stamp_x = data_stamps[self.border1: self.border2]
-        self.data_stamp_y = data_stamps[self.border1: self.border2]
-        indexes = [(a[0] - indexes[self.border1][0][0], a[1]) for a in
-                   itertools.chain(*indexes[self.border1: self.border2])]
-        self.index = [x for i, x in enumerate(indexes) if i % self.stride == 0]
+        if self.flow_times is None:
+            marks = np.stack([self._get_marks(self.data_stamp_x[f], b, b + length) for f, b in
+                              zip(flows.tolist(), begins.tolist())])
+        else:
+            steps = begins[:, None] + np.arange(length)
+            marks = calendar_marks(self.flow_times[flows, None] + (
+                    steps * 1000000 // self.flow_aggrs[flows, None]).astype('timedelta64[us]')).astype(np.float32)
+
+        r_begin = self.seq_len - self.label_len
+        return seq[:, :self.seq_len], seq[:, r_begin:], marks[:, :self.seq_len], marks[:, r_begin:]
 
     def __getitem__(self, index):
-        index = self.index[index]
+        if isinstance(index, list):  # indices of a batch from the BatchSampler of data_provider
+            return self.get_batch(index)
+
+        index = self._window(index)
 
         s_begin = index[1]
         s_end = s_begin + self.seq_len
@@ -130,22 +313,40 @@ class Dataset_Traffic_Even(Dataset):
 
         seq_x = self.data_x[index[0]][s_begin:s_end]
         seq_y = self.data_y[index[0]][r_begin:r_end]
-        seq_x_mark = self.data_stamp_x[index[0]][s_begin:s_end]
-        seq_y_mark = self.data_stamp_y[index[0]][r_begin:r_end]
+        if self.scale:
+            seq_x = self.scaler.transform_array(seq_x, dtype=np.float32)
+            seq_y = self.scaler.transform_array(seq_y, dtype=np.float32)
+        else:
+            seq_x = seq_x.astype(np.float32, copy=False)
+            seq_y = seq_y.astype(np.float32, copy=False)
+        seq_x_mark = self._get_marks(self.data_stamp_x[index[0]], s_begin, s_end)
+        seq_y_mark = self._get_marks(self.data_stamp_y[index[0]], r_begin, r_end)
 
         return seq_x, seq_y, seq_x_mark, seq_y_mark
 
+    @staticmethod
+    def _get_marks(data_stamp, begin, end):
+        if isinstance(data_stamp, np.ndarray):  # time marks of every step (older processed files)
+            return data_stamp[begin:end].astype(np.float32)
+
+        start, aggr = data_stamp
+        return time_marks(start, end - begin, aggr, offset=begin).astype(np.float32)
+
     def __len__(self):
-        return len(self.index)  # len(self.data_x) - self.seq_len - self.pred_len + 1
+        return (int(self.window_offsets[-1]) + self.stride - 1) // self.stride
 
     def inverse_transform(self, data):
         return self.scaler.inverse_transform(data)
 
+    def inverse_transform_array(self, data):
+        return inverse_transform_array(self.scaler, data)
+
 
 class Dataset_Traffic_Even_nstft(Dataset):
     def __init__(self, root_path, flag='train', size=None,
                  features='S', data_path='univ1_pt1_even.csv',
-                 target='OT', scale=True, timeenc=0, freq='h', stride=100, transform=None, smooth_param=None):
+                 target='OT', scale=True, timeenc=0, freq='h', stride=100, transform=None, smooth_param=None,
+                 cache_path=None, splits=None):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -178,10 +379,11 @@ class Dataset_Traffic_Even_nstft(Dataset):
         self.scaler = StandardScalerList()
         self.scaler_y = StandardScalerList()  # for stft
 
-        with open(os.path.join(self.root_path, self.data_path), 'rb') as f:
-            data_raw: list[list] = pickle.load(f)  # returns list[list]
+        self.seg_len, self.seg_overlap = tuple(ast.literal_eval(self.smooth_param))
+        # flows and their stft frames are computed once and memory mapped
+        store = open_stft_store(os.path.join(self.root_path, self.data_path), self.seg_len, self.seg_overlap)
 
-        print(f"[+] Loaded {len(data_raw)} flows.")
+        print(f"[+] Loaded {len(store)} flows.")
 
         f = []
 
@@ -194,43 +396,29 @@ class Dataset_Traffic_Even_nstft(Dataset):
         data_stamps_y = []
         data_y = []  # only needed for stft
 
-        for i in range(len(data_raw)):
-            if len(data_raw[i]) < self.seq_len + self.pred_len:
+        for i in range(len(store)):
+            data_stamp_y, data_bytes_y = store.flow(i)
+            if len(data_bytes_y) < self.seq_len + self.pred_len:
                 continue
 
-            data_stamp = np.array(list(map(lambda x: x[0], data_raw[i])))
-            data_bytes_flow = np.array(list(map(lambda x: x[1], data_raw[i]))).reshape(-1, 1)
-
-            data_stamp_y = data_stamp.copy()
-            data_bytes_y = data_bytes_flow.copy()
-
-            self.seg_len, self.seg_overlap = tuple(ast.literal_eval(self.smooth_param))
-            # stft
-            stft_f, stft_time, data_bytes_flow = stft(data_bytes_flow.flatten(), nperseg=self.seg_len,
-                                                      noverlap=self.seg_overlap, boundary=None)
-            data_bytes_flow = data_bytes_flow.transpose()
+            data_bytes_flow, stft_time = store.flow_frames(i)
 
             if len(data_bytes_flow) < self.seq_len + (self.pred_len / (self.seg_len - self.seg_overlap)):
                 continue
 
-            data_bytes_flow = np.concatenate((data_bytes_flow.real, data_bytes_flow.imag), axis=1)
-            data_stamp = data_stamp[stft_time.astype(int).tolist()]
-
             indexes.append([[len(data), j] for j in range(len(data_bytes_flow) - self.seq_len -
                                                           (self.pred_len // (self.seg_len - self.seg_overlap)))])
-            indexes_y.append(stft_time.astype(int).tolist())
+            indexes_y.append(stft_time)
 
-            f.append(stft_f)
+            f.append(store.freqs)
 
             data.append(data_bytes_flow)
-            data_stamps.append(data_stamp)
+            data_stamps.append(stft_time)  # time stamps of the frames are data_stamp_y[stft_time]
 
             data_stamps_y.append(data_stamp_y)
             data_y.append(data_bytes_y)
 
-        print(f"[+] Found {sum([len(x) for x in data])} sequences in {len(data_raw)} flows.")
-        # data_stamps = np.array(data_stamps)
-        # data = np.stack(data)
+        print(f"[+] Found {sum([len(x) for x in data])} sequences in {len(store)} flows.")
 
         assert len(data_stamps) == len(data)
         assert len(data) == len(data_y)
@@ -244,13 +432,12 @@ class Dataset_Traffic_Even_nstft(Dataset):
         self.border2 = border2s[self.set_type]
 
         if self.scale:
+            # only fitted here - the windows are scaled in __getitem__ so the flows can stay memory mapped
             train_data = data[border1s[0]:border2s[0]]
             self.scaler.fit(train_data)
-            data = self.scaler.transform(data)
 
             train_data_y = data_y[border1s[0]:border2s[0]]  # gets the same flows as data[...]
             self.scaler_y.fit(train_data_y)
-            data_y = self.scaler_y.transform(data_y)
 
         self.data_x = data[self.border1: self.border2]
         self.data_y = data_y[self.border1: self.border2]
@@ -274,7 +461,10 @@ class Dataset_Traffic_Even_nstft(Dataset):
 
         seq_x = self.data_x[index[0]][s_begin:s_end]
         seq_y = self.data_y[index[0]][r_begin:r_end]
-        seq_x_mark = self.data_stamp_x[index[0]][s_begin:s_end]
+        if self.scale:
+            seq_x = self.scaler.transform_array(seq_x, dtype=np.float32)
+            seq_y = self.scaler_y.transform_array(seq_y, dtype=np.float32)
+        seq_x_mark = self.data_stamp_y[index[0]][self.data_stamp_x[index[0]][s_begin:s_end]]
         seq_y_mark = self.data_stamp_y[index[0]][r_begin:r_end]
 
         return seq_x, seq_y, seq_x_mark, seq_y_mark
@@ -285,11 +475,15 @@ class Dataset_Traffic_Even_nstft(Dataset):
     def inverse_transform(self, data):  # can only transform target not context/input!!!
         return self.scaler_y.inverse_transform(data)
 
+    def inverse_transform_array(self, data):
+        return inverse_transform_array(self.scaler_y, data)
+
 
 class Dataset_Traffic_Even_stft_only(Dataset):
     def __init__(self, root_path, flag='train', size=None,
                  features='S', data_path='univ1_pt1_even.csv',
-                 target='OT', scale=True, timeenc=0, freq='h', stride=100, transform=None, smooth_param=None):
+                 target='OT', scale=True, timeenc=0, freq='h', stride=100, transform=None, smooth_param=None,
+                 cache_path=None, splits=None):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -321,10 +515,11 @@ class Dataset_Traffic_Even_stft_only(Dataset):
     def __read_data__(self):
         self.scaler = StandardScalerList()
 
-        with open(os.path.join(self.root_path, self.data_path), 'rb') as f:
-            data_raw: list[list] = pickle.load(f)  # returns list[list]
+        self.seg_len, self.seg_overlap = tuple(ast.literal_eval(self.smooth_param))
+        # flows and their stft frames are computed once and memory mapped
+        store = open_stft_store(os.path.join(self.root_path, self.data_path), self.seg_len, self.seg_overlap)
 
-        print(f"[+] Loaded {len(data_raw)} flows.")
+        print(f"[+] Loaded {len(store)} flows.")
 
         f = []
 
@@ -333,34 +528,23 @@ class Dataset_Traffic_Even_stft_only(Dataset):
         data_stamps = []
         data = []
 
-        for i in range(len(data_raw)):
-            if len(data_raw[i]) < self.seq_len + self.pred_len:
+        for i in range(len(store)):
+            data_stamp, data_bytes_flow = store.flow(i)
+            if len(data_bytes_flow) < self.seq_len + self.pred_len:
                 continue
 
-            data_stamp = np.array(list(map(lambda x: x[0], data_raw[i])))
-            data_bytes_flow = np.array(list(map(lambda x: x[1], data_raw[i]))).reshape(-1, 1)
-
-            self.seg_len, self.seg_overlap = tuple(ast.literal_eval(self.smooth_param))
-            # stft
-            stft_f, stft_time, data_bytes_flow = stft(data_bytes_flow.flatten(), nperseg=self.seg_len,
-                                                      noverlap=self.seg_overlap, boundary=None)
-            data_bytes_flow = data_bytes_flow.transpose()
+            data_bytes_flow, stft_time = store.flow_frames(i)
 
             if len(data_bytes_flow) < self.seq_len + self.pred_len:
                 continue
 
-            data_bytes_flow = np.concatenate((data_bytes_flow.real, data_bytes_flow.imag), axis=1)
-            data_stamp = data_stamp[stft_time.astype(int).tolist()]
-
             indexes.append([[len(data), j] for j in range(len(data_bytes_flow) - self.seq_len - self.pred_len)])
-            f.append(stft_f)
+            f.append(store.freqs)
 
             data.append(data_bytes_flow)
-            data_stamps.append(data_stamp)
+            data_stamps.append((data_stamp, stft_time))  # time stamps of the frames are data_stamp[stft_time]
 
-        print(f"[+] Found {sum([len(x) for x in data])} sequences in {len(data_raw)} flows.")
-        # data_stamps = np.array(data_stamps)
-        # data = np.stack(data)
+        print(f"[+] Found {sum([len(x) for x in data])} sequences in {len(store)} flows.")
 
         assert len(data_stamps) == len(data)
 
@@ -373,9 +557,9 @@ class Dataset_Traffic_Even_stft_only(Dataset):
         self.border2 = border2s[self.set_type]
 
         if self.scale:
+            # only fitted here - the windows are scaled in __getitem__ so the flows can stay memory mapped
             train_data = data[border1s[0]:border2s[0]]
             self.scaler.fit(train_data)
-            data = self.scaler.transform(data)
 
         self.data_x = data[self.border1: self.border2]
         self.data_y = data[self.border1: self.border2]
@@ -398,8 +582,12 @@ class Dataset_Traffic_Even_stft_only(Dataset):
 
         seq_x = self.data_x[index[0]][s_begin:s_end]
         seq_y = self.data_y[index[0]][r_begin:r_end]
-        seq_x_mark = self.data_stamp_x[index[0]][s_begin:s_end]
-        seq_y_mark = self.data_stamp_y[index[0]][r_begin:r_end]
+        if self.scale:
+            seq_x = self.scaler.transform_array(seq_x, dtype=np.float32)
+            seq_y = self.scaler.transform_array(seq_y, dtype=np.float32)
+        data_stamp, stft_time = self.data_stamp_x[index[0]]
+        seq_x_mark = data_stamp[stft_time[s_begin:s_end]]
+        seq_y_mark = data_stamp[stft_time[r_begin:r_end]]
 
         return seq_x, seq_y, seq_x_mark, seq_y_mark
 
@@ -409,11 +597,15 @@ class Dataset_Traffic_Even_stft_only(Dataset):
     def inverse_transform(self, data):  # can only transform target not context/input!!!
         return self.scaler.inverse_transform(data)
 
+    def inverse_transform_array(self, data):
+        return inverse_transform_array(self.scaler, data)
+
 
 class Dataset_ETT_hour(Dataset):
     def __init__(self, root_path, flag='train', size=None,
                  features='S', data_path='ETTh1.csv',
-                 target='OT', scale=True, timeenc=0, freq='h', stride=1000, transform=False, smooth_param=None):
+                 target='OT', scale=True, timeenc=0, freq='h', stride=1000, transform=False, smooth_param=None,
+                 cache_path=None, splits=None):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -501,11 +693,15 @@ class Dataset_ETT_hour(Dataset):
     def inverse_transform(self, data):
         return self.scaler.inverse_transform(data)
 
+    def inverse_transform_array(self, data):
+        return inverse_transform_array(self.scaler, data)
+
 
 class Dataset_ETT_minute(Dataset):
     def __init__(self, root_path, flag='train', size=None,
                  features='S', data_path='ETTm1.csv',
-                 target='OT', scale=True, timeenc=0, freq='t', stride=1000, transform=False, smooth_param=None):
+                 target='OT', scale=True, timeenc=0, freq='t', stride=1000, transform=False, smooth_param=None,
+                 cache_path=None, splits=None):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -591,11 +787,15 @@ class Dataset_ETT_minute(Dataset):
     def inverse_transform(self, data):
         return self.scaler.inverse_transform(data)
 
+    def inverse_transform_array(self, data):
+        return inverse_transform_array(self.scaler, data)
+
 
 class Dataset_Custom(Dataset):
     def __init__(self, root_path, flag='train', size=None,
                  features='S', data_path='ETTh1.csv',
-                 target='OT', scale=True, timeenc=0, freq='h', stride=1000, transform=False, smooth_param=None):
+                 target='OT', scale=True, timeenc=0, freq='h', stride=1000, transform=False, smooth_param=None,
+                 cache_path=None, splits=None):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -692,12 +892,15 @@ class Dataset_Custom(Dataset):
     def inverse_transform(self, data):
         return self.scaler.inverse_transform(data)
 
+    def inverse_transform_array(self, data):
+        return inverse_transform_array(self.scaler, data)
+
 
 class Dataset_Pred(Dataset):
     def __init__(self, root_path, flag='pred', size=None,
                  features='S', data_path='ETTh1.csv',
                  target='OT', scale=True, inverse=False, timeenc=0, freq='15min', cols=None, stride=1000,
-                 transform=False, smooth_param=None):
+                 transform=False, smooth_param=None, cache_path=None, splits=None):
         # size [seq_len, label_len, pred_len]
         # info
         if size == None:
@@ -798,3 +1001,6 @@ class Dataset_Pred(Dataset):
 
     def inverse_transform(self, data):
         return self.scaler.inverse_transform(data)
+
+    def inverse_transform_array(self, data):
+        return inverse_transform_array(self.scaler, data)
@@ -4,7 +4,6 @@ from os import listdir
 from os.path import isfile, join
 import pickle
 
-import datetime
 import random
 from statistics import mean
 
@@ -12,17 +11,25 @@ import numpy as np
 import torch
 
 from utils.data_preparation_tools import (
+    aggregate_flows_gpu,
     create_test_from_full,
+    reduce_series_gpu,
     parse_pcap_to_list_n,
-    split_tensor_gpu,
+    parse_pcap_to_list_parallel,
+    parse_pcap_to_list_raw,
+    parse_pcap_to_list_stream,
+    split_segments_gpu,
 )
+from utils.flow_store import flow_packets, is_flow_store, load_flows
+from utils.sequence_store import SequenceStore
+from utils.stft_store import write_stft_store
 
 
 class DataTransformerBase:
     def __init__(self, file_path: str):
         self.file_path = file_path
 
-        if not file_path.endswith(".pkl"):
+        if not file_path.endswith(".pkl") and not is_flow_store(file_path):
             raise AttributeError(
                 "Muss ein phl file sein. Wenn es noch ein pcap file ist. Parse mit Methode!"
             )
@@ -32,20 +39,28 @@ class DataTransformerBase:
 
     def _load_packet_from_pkl(self, file_path) -> list:
         print(f"[+] Loading packets from pkl file with location: {self.file_path} ...")
-        with open(file_path, "rb") as f:
-            data = pickle.load(f)
+        return load_flows(file_path)  # pickled dict or flow store
 
-        return data
+    def save_python_object(self, py_save_path: str, data=None) -> str:
+        data = self.data if data is None else data
 
-    def save_python_object(self, py_save_path: str) -> str:
         with open(py_save_path, "wb") as f:
-            pickle.dump(self.data, f)
+            pickle.dump(data, f)
 
         print(
-            f"[+] Wrote {len(self.data)} successfully in file with path {py_save_path}"
+            f"[+] Wrote {len(data)} successfully in file with path {py_save_path}"
         )
         return py_save_path
 
+    def save_sequence_store(self, store_save_path: str, data=None, dtype=np.float32) -> str:
+        data = self.data if data is None else data
+        SequenceStore.write(store_save_path, data, dtype=dtype)
+
+        print(
+            f"[+] Wrote {len(data)} successfully in sequence store with path {store_save_path}"
+        )
+        return store_save_path
+
     def save_csv(self, csv_save_path: str):
         with open(csv_save_path, mode="w", newline="") as file:
             writer = csv.writer(file)
@@ -66,7 +81,7 @@ class DatatransformerEvenSimpleGpu(DataTransformerBase):
         file_path: str,
         consecutive_zeros=500,
         min_length: int = 1000,
-        aggr: int = 1000,
+        aggr=1000,  # or a list of aggregation times
     ):
         self.aggr = aggr
         self.min_length = min_length
@@ -74,6 +89,19 @@ class DatatransformerEvenSimpleGpu(DataTransformerBase):
 
         super().__init__(file_path)
 
+    @staticmethod
+    def _batches(flows: list, series_lengths: list, max_length: int = 2**26):
+        # groups flows so that the aggregated series of a batch have at most max_length steps (or one flow)
+        batch, length = [], 0
+        for i in flows:
+            if batch and length + series_lengths[i] > max_length:
+                yield batch
+                batch, length = [], 0
+            batch.append(i)
+            length += series_lengths[i]
+        if batch:
+            yield batch
+
     @staticmethod
     def _filter(data_flows: dict, filter_tcp=True, shuffle=12):
         keys = list(data_flows.keys())
@@ -107,104 +135,92 @@ class DatatransformerEvenSimpleGpu(DataTransformerBase):
 
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+        # several resolutions are derived from the finest one by summing blocks of bins
+        aggrs = self.aggr if isinstance(self.aggr, list) else [self.aggr]
+        finest = max(aggrs)
+
+        if any(finest % aggr != 0 for aggr in aggrs):
+            raise AttributeError(f"All aggregation times {aggrs} have to divide the finest one {finest}.")
+
         # random.shuffle(data_flows)  # tries to balance load
         data_flows = self._filter(data_flows)
 
         print(f"[+] Found {len(data_flows)} allowed flows after filtering.")
 
-        data_flows = list(data_flows.values())
-
-        for i in range(len(data_flows)):
-            data_flows[i] = torch.tensor(
-                [x[:2] for x in data_flows[i]], device=device, dtype=torch.float64
-            )
+        data_flows = [torch.from_numpy(flow_packets(f)) for f in data_flows.values()]
 
-        flow_seq = []
+        # length of the aggregated series per flow - short flows are skipped before aggregation
+        series_lengths = [int(f[-1, 0] * finest) + 1 - int(f[0, 0] * finest) + 1 for f in data_flows]
+        flows = [i for i, length in enumerate(series_lengths) if length >= self.min_length]
 
-        print("[+] Starting data flow transformation and splitting...")
+        flow_seqs = {aggr: [] for aggr in aggrs}
         counter = 0
-        for flow in data_flows:
-            start_time = int(flow[0, 0] * self.aggr)  # assumes packets are ordered
-            end_time = int(flow[-1, 0] * self.aggr) + 1
-            flow_series_bytes = torch.zeros(
-                end_time - start_time + 1, device=device, dtype=torch.float64
-            )
 
-            if flow_series_bytes.shape[0] < self.min_length:
-                counter += 1
-                continue
+        print("[+] Starting data flow transformation and splitting...")
+        for batch in self._batches(flows, series_lengths):
+            packets = torch.cat([data_flows[i] for i in batch]).to(device)
+            packet_offsets = torch.zeros(len(batch) + 1, dtype=torch.long)
+            packet_offsets[1:] = torch.cumsum(torch.tensor([data_flows[i].shape[0] for i in batch]), dim=0)
 
-            flow_series_time = torch.arange(
-                start_time, end_time + 1, device=device, dtype=torch.float64
-            )
+            aggregated = aggregate_flows_gpu(packets, packet_offsets.to(device), finest)
 
-            packet_times = ((flow[:, 0] * self.aggr) - start_time).long()
-            flow_series_bytes.index_add_(0, packet_times, flow[:, 1])
-            flow_series_bytes = torch.stack(
-                (flow_series_time / self.aggr, flow_series_bytes), dim=1
-            )
-            flow_series_bytes = split_tensor_gpu(
-                flow_series_bytes, consecutive_zeros=self.consecutive_zeros
-            )
-            flow_series_bytes = [
-                f.to("cpu") for f in flow_series_bytes if f.shape[0] > self.min_length
-            ]
-            flow_seq.extend(flow_series_bytes)
+            for aggr in aggrs:
+                if aggr == finest:
+                    flow_seqs[aggr].extend(self._split(*aggregated, aggr=aggr))
+                else:
+                    flow_seqs[aggr].extend(self._split(*reduce_series_gpu(*aggregated, finest // aggr), aggr=aggr))
 
-            if counter % 1000 == 0:
+            counter += len(batch)
+            for aggr, flow_seq in flow_seqs.items():
                 print(
-                    f"[+] Found {len(flow_seq)} in {counter / len(data_flows)} % | Splitted Flow Length Mean {mean([0] + [len(x) for x in flow_seq])}"
+                    f"[+] Aggr {aggr}: Found {len(flow_seq)} in {counter / len(flows)} % | Splitted Flow Length Mean {mean([0] + [len(x[1]) for x in flow_seq])}"
                 )
-            counter += 1
 
-        print(
-            f"[+] Found sequences: {len(flow_seq)} in {len(data_flows)} flows. "
-            f"Real preds: {len([x for x in flow_seq if x.shape[0] > 2 * self.consecutive_zeros]) / len(flow_seq)} Parsing timestamps...."
-        )
-
-        def mapping2(time):
-            return [
-                time.month,
-                time.day,
-                time.weekday(),
-                time.hour,
-                time.minute,
-                time.second,
-                time.microsecond // 1000,
-                time.microsecond % 1000,
-            ]
-
-        def mapping(x):
-            time = datetime.datetime.fromtimestamp(x[0, 0].item())
-            time_in_tensor = np.array(
-                [
-                    mapping2(time + datetime.timedelta(milliseconds=t_d))
-                    for t_d in range(x.shape[0])
-                ]
+        for aggr, flow_seq in flow_seqs.items():
+            print(
+                f"[+] Aggr {aggr}: Found sequences: {len(flow_seq)} in {len(data_flows)} flows. "
+                f"Real preds: {len([x for x in flow_seq if x[1].shape[0] > 2 * self.consecutive_zeros]) / max(len(flow_seq), 1)}"
             )
-            features = x[:, 1:].detach().numpy()
 
-            return [time_in_tensor, features]
+        return flow_seqs if isinstance(self.aggr, list) else flow_seqs[self.aggr]
 
-        counter = 0
-        for i, x in enumerate(flow_seq):
-            flow_seq[i] = mapping(x)
+    def _split(self, series, series_offsets, start_times, aggr):
+        # flows that are shorter than min_length can only have shorter sequences, so they are dropped here as well
+        starts, ends = split_segments_gpu(
+            series, series_offsets, consecutive_zeros=self.consecutive_zeros
+        )
 
-            if counter % 1000 == 0:
-                print(f"Parsed {counter / len(flow_seq)}")
-            counter += 1
+        keep = (ends - starts) > self.min_length
+        starts, ends = starts[keep], ends[keep]
+        seq_flows = torch.searchsorted(series_offsets, starts, right=True) - 1
+        seq_times = (
+            start_times[seq_flows] + starts - series_offsets[seq_flows]
+        ).double() / aggr
 
-        return flow_seq
+        # single transfer of the whole batch
+        series = series.cpu().numpy()
 
+        # only the start and the bin width are stored - the time marks are derived by the dataset (time_marks)
+        return [
+            [(t, aggr), series[s:e].reshape(-1, 1).astype(np.float32)]
+            for t, s, e in zip(seq_times.tolist(), starts.tolist(), ends.tolist())
+        ]
 
-def _save_even_gpu(load_path: str, save_path: str, aggr_time: list):
-    for j in aggr_time:
-        save_path_ = save_path + f"_{j}.pkl"
-        data_transformer = DatatransformerEvenSimpleGpu(
-            load_path, consecutive_zeros=500, min_length=800, aggr=j
-        )
 
-        data_transformer.save_python_object(save_path_)
+def _save_even_gpu(load_path: str, save_path: str, aggr_time: list, sequence_store: bool = False,
+                   dtype=np.float32):
+    # all aggregation times come out of one run over the packets
+    data_transformer = DatatransformerEvenSimpleGpu(
+        load_path, consecutive_zeros=500, min_length=800, aggr=aggr_time
+    )
+
+    for j in aggr_time:
+        if sequence_store:
+            save_path_ = save_path + f"_{j}"
+            data_transformer.save_sequence_store(save_path_, data=data_transformer.data[j], dtype=dtype)
+        else:
+            save_path_ = save_path + f"_{j}.pkl"
+            data_transformer.save_python_object(save_path_, data=data_transformer.data[j])
         print(f"[x] Finished aggr {j} and saved it in {save_path_}")
 
 
@@ -213,25 +229,44 @@ if __name__ == "__main__":
         "<<<<<<<<<<<<<<<< Start - be aware that certain parameters need to be configured >>>>>>>>>>>>>>>>"
     )
     all = True  # True if all Flows should be used - False if they should be filtered
+    parser = "raw"  # scapy: whole captures, stream: scapy packet by packet, raw: header decoding without scapy
+    parallel = True  # True if every pcap file should be parsed in its own process
+    flow_store = True  # True if the flows should be saved in the columnar flow store instead of a pkl file (needs parallel, stream or raw)
+    sequence_store = True  # True if the processed data should be saved as memory mapped sequence store instead of a pkl file
+    storage_dtype = np.float32  # np.float16 halves the sequence store again but only holds values up to 65504
+    stft_pairs = [(16, 14), (32, 28), (48, 42)]  # (seg_len, overlap) of the frames precomputed for the stft datasets
 
     pathToDataDir = "data/"  # configure if required
     data_path = [f for f in listdir(pathToDataDir) if isfile(join(pathToDataDir, f))]
-    save_path = join(pathToDataDir, "data_flows.pkl")
+    save_path = join(pathToDataDir, "data_flows" if flow_store else "data_flows.pkl")
 
     # Load from pcap files - may only need to be run if not already loaded
-    parse_pcap_to_list_n(data_path, save_path)
+    if parallel:
+        parse_pcap_to_list_parallel(data_path, save_path, parser=parser)
+    elif parser == "raw":
+        parse_pcap_to_list_raw(data_path, save_path)
+    elif parser == "stream":
+        parse_pcap_to_list_stream(data_path, save_path)
+    else:
+        parse_pcap_to_list_n(data_path, save_path)
 
     # Optional
-    test_save_path = join(pathToDataDir, "data_flows_test.pkl")
+    test_save_path = join(pathToDataDir, "data_flows_test" if flow_store else "data_flows_test.pkl")
     create_test_from_full(
         save_path, test_save_path, amount=50
     )  # configure if required - look at shuffle if you need it
 
     final_data_path = save_path if all else test_save_path
-    final_save_path = join(pathToDataDir, "processed_data.pkl")
+    final_save_path = join(pathToDataDir, "processed_data")
     aggregation_time = [1000, 100]
 
-    _save_even_gpu(final_data_path, final_save_path, aggr_time=aggregation_time)
+    _save_even_gpu(final_data_path, final_save_path, aggr_time=aggregation_time, sequence_store=sequence_store,
+                   dtype=storage_dtype)
+
+    # Optional
+    for j in aggregation_time:
+        processed_path = final_save_path + (f"_{j}" if sequence_store else f"_{j}.pkl")
+        write_stft_store(processed_path, final_save_path + f"_{j}_stft", stft_pairs)
 
     print(f"Saved the data in {final_save_path}!")
     print(">>>>>>>>>>>>>>>>>>>> Finshed <<<<<<<<<<<<<<<<")
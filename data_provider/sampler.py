@@ -0,0 +1,40 @@
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+class ChunkShuffleSampler(Sampler):
+    """Shuffles chunks of consecutive windows instead of single windows.
+    The indices are cut into chunks of chunk_size windows that never span two flows (if the dataset has the
+    window_offsets of Dataset_Traffic_Even). The chunks are visited in random order and buffer_chunks of them are
+    mixed and shuffled at a time, so only a few regions of the (memory mapped) flow buffer are read at once.
+    """
+
+    def __init__(self, data_source, chunk_size: int = 1024, buffer_chunks: int = 16, generator=None):
+        self.data_source = data_source
+        self.chunk_size = chunk_size
+        self.buffer_chunks = buffer_chunks
+        self.generator = generator
+
+        n = len(data_source)
+        starts = np.arange(0, n, chunk_size)
+        window_offsets = getattr(data_source, 'window_offsets', None)
+        if window_offsets is not None:
+            flow_starts = -(-window_offsets[:-1] // data_source.stride)  # first used window of every flow
+            starts = np.union1d(starts, flow_starts[flow_starts < n])
+        self.bounds = np.append(starts, n)
+
+    def __iter__(self):
+        generator = self.generator
+        if generator is None:
+            generator = torch.Generator()
+            generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+
+        order = torch.randperm(len(self.bounds) - 1, generator=generator).numpy()
+        for i in range(0, len(order), self.buffer_chunks):
+            indices = np.concatenate([np.arange(self.bounds[c], self.bounds[c + 1]) for c in
+                                      order[i:i + self.buffer_chunks]])
+            yield from indices[torch.randperm(len(indices), generator=generator).numpy()].tolist()
+
+    def __len__(self):
+        return len(self.data_source)
@@ -2,11 +2,12 @@ from exp.exp_basic import Exp_Basic
 from models import Informer, Transformer, DLinear, Linear, NLinear, PatchTST, \
     RLinear, STFTformer, Mean
 from models.ns_models import ns_Transformer
-from utils.tools import adjust_learning_rate
-from utils.metrics import metric, pearson
+from utils.tools import adjust_learning_rate, load_checkpoint, save_checkpoint, rng_state, set_rng_state
+from utils.metrics import MetricAccumulator, PearsonAccumulator, TrajectoryReservoir
 import torch
 import torch.nn as nn
 from torch.optim import lr_scheduler
+import os
 import time
 import warnings
 import numpy as np
@@ -17,6 +18,8 @@ warnings.filterwarnings('ignore')
 class Exp_Main(Exp_Basic):
     def __init__(self, args):
         super(Exp_Main, self).__init__(args)
+        self.scheduler = None
+        self.grad_scaler = None
 
     def _build_model(self):
         model_dict = {
@@ -69,8 +72,10 @@ class Exp_Main(Exp_Basic):
         return outputs, batch_y
 
     def vali(self, vali_data, vali_loader, criterion):
-        true_pred = []
-        total_loss = []
+        metrics = MetricAccumulator()
+        reservoir = TrajectoryReservoir()
+        total_loss = 0
+        steps = 0
 
         self.model.eval()
         with torch.no_grad():
@@ -82,18 +87,16 @@ class Exp_Main(Exp_Basic):
                 batch_y_mark = batch_y_mark.float().to(self.device)
 
                 outputs, batch_y = self._predict(batch_x, batch_y, batch_x_mark, batch_y_mark)
+                outputs = outputs.float()
 
-                pred = outputs.detach().cpu()
-                true = batch_y.detach().cpu()
+                total_loss = total_loss + criterion(outputs, batch_y)
+                steps += 1
 
-                loss = criterion(pred, true)
-
-                total_loss.append(loss)
-
-                true_pred.append((true.numpy(), pred.numpy()))
-        total_loss = np.average(total_loss)
+                metrics.update(outputs, batch_y)
+                reservoir.update(batch_y, outputs)
+        total_loss = total_loss.item() / steps if steps else np.nan
         self.model.train()
-        return total_loss, true_pred
+        return total_loss, reservoir.items(), metrics.results()
 
     def train(self, epoch: int, train_data, train_loader, criterion, model_optim):
         time_now = time.time()
@@ -106,14 +109,17 @@ class Exp_Main(Exp_Basic):
                                             pct_start=self.args.pct_start,
                                             epochs=self.args.iterations,
                                             max_lr=self.args.learning_rate)
+        self.scheduler = scheduler
 
-        if self.args.use_amp:
-            scaler = torch.cuda.amp.GradScaler()
+        if self.args.use_amp and self.grad_scaler is None:
+            self.grad_scaler = torch.cuda.amp.GradScaler()
+        scaler = self.grad_scaler
 
         iter_count = 0
-        train_loss = []
+        train_loss = 0
 
-        trues_preds = []
+        metrics = MetricAccumulator()
+        reservoir = TrajectoryReservoir()
 
         self.model.train()
         epoch_time = time.time()
@@ -129,9 +135,10 @@ class Exp_Main(Exp_Basic):
 
             outputs, batch_y = self._predict(batch_x, batch_y, batch_x_mark, batch_y_mark)
             loss = criterion(outputs, batch_y)
-            train_loss.append(loss.item())
+            train_loss = train_loss + loss.detach()
 
-            trues_preds.append((batch_y.detach().cpu().numpy(), outputs.detach().cpu().numpy()))
+            metrics.update(outputs, batch_y)
+            reservoir.update(batch_y, outputs)
 
             if (i + 1) % 100 == 0:
                 print("\t iters: {0} | loss: {1:.7f}".format(i + 1, loss.item()))
@@ -150,7 +157,7 @@ class Exp_Main(Exp_Basic):
                 model_optim.step()
 
         print("Epoch: {} cost time: {}".format(epoch + 1, time.time() - epoch_time))
-        train_loss = np.average(train_loss)
+        train_loss = train_loss.item() / train_steps if train_steps else np.nan
 
         print("Epoch: {0}, Steps: {1} | Train Loss: {2:.7f}".format(
             epoch + 1, train_steps, train_loss))
@@ -160,18 +167,17 @@ class Exp_Main(Exp_Basic):
         else:
             print('Updating learning rate to {}'.format(scheduler.get_last_lr()[0]))
 
-        return train_loss, trues_preds
+        return train_loss, reservoir.items(), metrics.results()
 
     def test(self, test_data, test_loader, test=0, inverse_scale=False):
         if test:
             print('loading model')
-            # TODO load model
-            # self.model.load_state_dict(torch.load(os.path.join('./checkpoints/' + setting, 'checkpoint.pth')))
+            self.load_checkpoint()
 
-        trues_preds = []
-        contexts = []
-        preds = []
-        trues = []
+        metrics = MetricAccumulator()
+        real_metrics = MetricAccumulator()
+        correlations = PearsonAccumulator()
+        reservoir = TrajectoryReservoir()
 
         self.model.eval()
         with torch.no_grad():
@@ -183,59 +189,38 @@ class Exp_Main(Exp_Basic):
                 batch_y_mark = batch_y_mark.float().to(self.device)
 
                 outputs, batch_y = self._predict(batch_x, batch_y, batch_x_mark, batch_y_mark)
+                outputs = outputs.float()
+                metrics.update(outputs, batch_y)
+                correlations.update(batch_x, outputs, batch_y)
 
-                context = batch_x.detach().cpu().numpy()
-                outputs = outputs.detach().cpu().numpy()
-                batch_y = batch_y.detach().cpu().numpy()
+                if inverse_scale:  # affine inverse of the whole batch on the device
+                    outputs = test_data.inverse_transform_array(outputs)
+                    batch_y = test_data.inverse_transform_array(batch_y)
+                    real_metrics.update(outputs, batch_y)
 
-                trues_preds.append((batch_y, outputs))
-
-                pred = outputs  # outputs.detach().cpu().numpy()  # .squeeze()
-                true = batch_y  # batch_y.detach().cpu().numpy()  # .squeeze()
-
-                contexts.append(context)
-                preds.append(pred)
-                trues.append(true)
-
-        contexts = np.concatenate(contexts, axis=0)
-        preds = np.concatenate(preds, axis=0)
-        trues = np.concatenate(trues, axis=0)
+                reservoir.update(batch_y, outputs)
 
         results = {}
 
-        print('test shape:', preds.shape, trues.shape)
-        preds = preds.reshape(-1, preds.shape[-2], preds.shape[-1])
-        trues = trues.reshape(-1, trues.shape[-2], trues.shape[-1])
-        print('test shape:', preds.shape, trues.shape)
+        print('test samples:', metrics.samples)
 
-        p = pearson(contexts, preds, trues)
-        mae, mse, rmse, mape, mspe, hvi = metric(preds, trues)
+        p = correlations.compute()
+        mae, mse, rmse, mape, mspe, hvi = metrics.compute()
         print('mse:{}, mae:{}, rmse:{}'.format(mse, mae, rmse))
 
         results.update({'test_mse': mse, 'test_mae': mae, 'test_rmse': rmse,
                         'test_mape': mape, 'test_mspe': mspe, 'hvi': hvi, 'pearson': p})
 
         if inverse_scale:
-            preds_inverse = np.stack([test_data.inverse_transform(x) for x in preds])
-            trues_inverse = np.stack([test_data.inverse_transform(x) for x in trues])
-
-            preds_inverse = preds_inverse.reshape(-1, preds_inverse.shape[-2], preds_inverse.shape[-1])
-            trues_inverse = trues_inverse.reshape(-1, trues_inverse.shape[-2], trues_inverse.shape[-1])
-
-            mae, mse, rmse, mape, mspe, hvi = metric(preds_inverse, trues_inverse)
+            mae, mse, rmse, mape, mspe, hvi = real_metrics.compute()
             results.update({'real_test_mse': mse, 'real_test_mae': mae, 'real_test_rmse': rmse,
                             'real_test_mape': mape, 'real_test_mspe': mspe, 'real_test_hvi': hvi})
 
-            trues_preds = list(zip(trues_inverse, preds_inverse))
-
-        return results, trues_preds
+        return results, reservoir.items()
 
     def predict(self, pred_data, pred_loader, load=False):
         if load:
-            pass
-            # path = os.path.join(self.args.checkpoints, setting)
-            # best_model_path = path + '/' + 'checkpoint.pth'
-            # self.model.load_state_dict(torch.load(best_model_path))
+            self.load_checkpoint()
 
         preds = []
 
@@ -256,3 +241,43 @@ class Exp_Main(Exp_Basic):
         preds = preds.reshape(-1, preds.shape[-2], preds.shape[-1])
 
         return preds
+
+    def checkpoint_path(self):
+        return os.path.join(self.args.checkpoints, 'checkpoint.pth')
+
+    def save_checkpoint(self, epoch: int, model_optim, path=None):
+        state = {'epoch': epoch,
+                 'model': self.model.state_dict(),
+                 'optimizer': model_optim.state_dict(),
+                 'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+                 'grad_scaler': self.grad_scaler.state_dict() if self.grad_scaler is not None else None,
+                 'rng': rng_state()}
+        save_checkpoint(state, path or self.checkpoint_path())
+        print(f"[+] Saved checkpoint of epoch {epoch + 1} in {path or self.checkpoint_path()}.")
+
+    def load_checkpoint(self, path=None, model_optim=None, required=True):
+        """Loads the model of a checkpoint of save_checkpoint. With model_optim the optimizer, the learning rate
+        scheduler, the GradScaler and the random states are restored as well to resume the training. Returns the
+        epoch of the checkpoint - a missing checkpoint raises a FileNotFoundError unless it is not required, then
+        None is returned."""
+        path = path or self.checkpoint_path()
+        if not os.path.isfile(path):
+            if required:
+                raise FileNotFoundError(f"No checkpoint in {path}.")
+            print(f"[-] No checkpoint in {path}.")
+            return None
+
+        print(f"[+] Loading checkpoint with location: {path} ...")
+        state = load_checkpoint(path, map_location=self.device)
+        self.model.load_state_dict(state['model'])
+
+        if model_optim is not None:
+            model_optim.load_state_dict(state['optimizer'])
+            if self.scheduler is not None and state['scheduler'] is not None:
+                self.scheduler.load_state_dict(state['scheduler'])
+            if self.args.use_amp and state['grad_scaler'] is not None:
+                self.grad_scaler = torch.cuda.amp.GradScaler()
+                self.grad_scaler.load_state_dict(state['grad_scaler'])
+            set_rng_state(state['rng'])
+
+        return state['epoch']
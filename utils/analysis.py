@@ -15,7 +15,8 @@ from statsmodels.tsa.stattools import acf
 from torch import tensor
 from statsmodels.sandbox.stats.runs import runstest_1samp
 import statsmodels.api as sm
-from utils.data_preparation_tools import split_tensor_gpu
+from utils.data_preparation_tools import split_tensor_gpu_offsets
+from utils.flow_store import FlowStore, flow_packets, load_flows, save_flows
 
 
 def visualize_test():
@@ -65,8 +66,7 @@ def visualize_test():
 
 
 def visualize_flows(file_path, aggr=1000, min_length=2500, skip=0, amount=20, filter_tcp=True, shuffle=12):
-    with open(file_path, 'rb') as f:
-        data_flows = pickle.load(f)
+    data_flows = load_flows(file_path)
 
     keys = list(data_flows.keys())
 
@@ -87,7 +87,7 @@ def visualize_flows(file_path, aggr=1000, min_length=2500, skip=0, amount=20, fi
         k = keys[i]
         i += 1
 
-        flow = torch.tensor([x[:2] for x in data_flows[k]], dtype=torch.float64)
+        flow = torch.from_numpy(flow_packets(data_flows[k]))
         start_time = int(flow[0, 0] * aggr)  # assumes packets are ordered
         end_time = int(flow[-1, 0] * aggr) + 1
         flow_series_bytes = torch.zeros(end_time - start_time + 1, dtype=torch.float64)
@@ -117,8 +117,7 @@ def visualize_flows(file_path, aggr=1000, min_length=2500, skip=0, amount=20, fi
 
 def visualize_flows_stft(file_path, aggr=1000, consecutive_zeros=500, min_length=1000, amount=-1, filter_tcp=True,
                          shuffle=12):
-    with open(file_path, 'rb') as f:
-        data_flows = pickle.load(f)
+    data_flows = load_flows(file_path)
 
     keys = list(data_flows.keys())
 
@@ -133,7 +132,7 @@ def visualize_flows_stft(file_path, aggr=1000, consecutive_zeros=500, min_length
     keys = keys[:amount]
 
     for k in keys:
-        flow = torch.tensor([x[:2] for x in data_flows[k]], dtype=torch.float64)
+        flow = torch.from_numpy(flow_packets(data_flows[k]))
         start_time = int(flow[0, 0] * aggr)  # assumes packets are ordered
         end_time = int(flow[-1, 0] * aggr) + 1
         flow_series_bytes = torch.zeros(end_time - start_time + 1, dtype=torch.float64)
@@ -193,8 +192,7 @@ def visualize_flows_stft(file_path, aggr=1000, consecutive_zeros=500, min_length
 
 
 def visualize_acf(file_path, aggr=1000, amount=20, nlags=1000, filter_tcp=True, shuffle=True, min_length=None):
-    with open(file_path, 'rb') as f:
-        data_flows = pickle.load(f)
+    data_flows = load_flows(file_path)
 
     keys = list(data_flows.keys())
 
@@ -226,7 +224,7 @@ def visualize_acf(file_path, aggr=1000, amount=20, nlags=1000, filter_tcp=True,
     keys = keys[:amount]
 
     for k in keys:
-        flow = torch.tensor([x[:2] for x in data_flows[k]], dtype=torch.float64)
+        flow = torch.from_numpy(flow_packets(data_flows[k]))
         start_time = int(flow[0, 0] * aggr)  # assumes packets are ordered
         end_time = int(flow[-1, 0] * aggr) + 1
         flow_series_bytes = torch.zeros(end_time - start_time + 1, dtype=torch.float64)
@@ -246,19 +244,17 @@ def visualize_acf(file_path, aggr=1000, amount=20, nlags=1000, filter_tcp=True,
 
 
 def count_packets(file_path):
-    with open(file_path, 'rb') as f:
-        data_flows = pickle.load(f)
+    data_flows = load_flows(file_path)
 
     counter = 0
-    for k, v in data_flows.items():
-        counter += len(v)
+    for k in data_flows.keys():
+        counter += data_flows.packet_count(k) if isinstance(data_flows, FlowStore) else len(data_flows[k])
 
     print(counter)
 
 
 def filter_flows(file_path, save_path, alpha=0.05, aggr=1000, filter_tcp=True, auto=False):
-    with open(file_path, 'rb') as f:
-        data_flows = pickle.load(f)
+    data_flows = load_flows(file_path)
 
     keys = list(data_flows.keys())
 
@@ -276,7 +272,7 @@ def filter_flows(file_path, save_path, alpha=0.05, aggr=1000, filter_tcp=True, a
 
         counter += 1
 
-        flow = torch.tensor([x[:2] for x in data_flows[k]], dtype=torch.float64)
+        flow = torch.from_numpy(flow_packets(data_flows[k]))
         start_time = int(flow[0, 0] * aggr)  # assumes packets are ordered
         end_time = int(flow[-1, 0] * aggr) + 1
         flow_series_bytes = torch.zeros(end_time - start_time + 1, dtype=torch.float64)
@@ -295,11 +291,8 @@ def filter_flows(file_path, save_path, alpha=0.05, aggr=1000, filter_tcp=True, a
     auto_mean = sorted(auto_mean, key=lambda x: abs(x[1]), reverse=True)
     auto_mean = [x for x in auto_mean if abs(x[1]) >= alpha]
 
-    data_flows = {x[0]: data_flows[x[0]] for x in auto_mean}
-
     # save results
-    with open(save_path, 'wb') as f:
-        pickle.dump(data_flows, f)
+    save_flows(data_flows, save_path, keys=[x[0] for x in auto_mean])
 
 
 def _compare(new_file_path, old_file_path):
@@ -351,15 +344,13 @@ def getData(data_flows: tensor, only_tcp=True):
 
 
 def analysis_gpu(file_path: str, save_path: str, aggr=1000, consecutive_zeros=500, only_tcp=True):
-    open_path = file_path if not os.path.exists(save_path) else save_path
-
-    with open(open_path, 'rb') as f:
-        data_flows = pickle.load(f)
-
     if os.path.exists(save_path):
-        getData(data_flows, only_tcp)
+        with open(save_path, 'rb') as f:
+            getData(pickle.load(f), only_tcp)
         return
 
+    data_flows = load_flows(file_path)
+
     print("[+] Starting data analysis...")
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -367,7 +358,7 @@ def analysis_gpu(file_path: str, save_path: str, aggr=1000, consecutive_zeros=50
     data_flows = list(data_flows.values())
 
     for i in range(len(data_flows)):
-        data_flows[i] = torch.tensor([x[:3] for x in data_flows[i]], device=device, dtype=torch.float64)
+        data_flows[i] = torch.from_numpy(flow_packets(data_flows[i], columns=3)).to(device)
 
     flow_data = []
 
@@ -383,35 +374,27 @@ def analysis_gpu(file_path: str, save_path: str, aggr=1000, consecutive_zeros=50
 
         packet_times = ((flow[:, 0] * aggr) - start_time).long()
         flow_series_bytes.index_add_(0, packet_times, flow[:, 1])
-        flow_series_split = torch.stack((torch.zeros(flow_series_bytes.shape[0], device=device), flow_series_bytes),
-                                        dim=1)
-        flow_series_split = split_tensor_gpu(flow_series_split, consecutive_zeros)
-        _, p = runstest_1samp(flow_series_bytes.tolist(), correction=False)
+        starts, ends = split_tensor_gpu_offsets(flow_series_bytes, consecutive_zeros)
+        series = flow_series_bytes.cpu().numpy()  # single transfer
+        _, p = runstest_1samp(series.tolist(), correction=False)
 
         if np.isnan(p):
             p = -1
 
-        ptm = []
-        vtm = []
-        b = []
-        a = []
-
-        for sub_flow in flow_series_split:
-            max_value = sub_flow[:, 1].max()
-            mean_ = sub_flow[:, 1].mean()
-            var_ = sub_flow[:, 1].var()
-
-            vtm_ = var_ / mean_
+        # statistics of all sub flows at once - sub flow i is series[starts[i]:ends[i]]
+        bounds = torch.stack((starts, ends), dim=1).flatten().cpu().numpy()
+        n = (ends - starts).cpu().numpy()
+        series = np.append(series, 0)  # reduceat needs valid indices for ends
 
-            ptm.append(max_value / mean_)
-            vtm.append(vtm_)
-            b.append((var_ - mean_) / (mean_ + var_))
+        max_value = np.maximum.reduceat(series, bounds)[::2]
+        mean_ = np.add.reduceat(series, bounds)[::2] / n
+        var_ = (np.add.reduceat(series ** 2, bounds)[::2] - n * mean_ ** 2) / (n - 1)
 
-            a.append((torch.sqrt(torch.tensor(sub_flow.shape[0], device=device) + 1) * vtm_ - torch.sqrt(
-                torch.tensor(sub_flow.shape[0], device=device) - 1)) /
-                     ((torch.sqrt(torch.tensor(sub_flow.shape[0], device=device) + 1) - 2) * vtm_ + torch.sqrt(
-                         torch.tensor(sub_flow.shape[0], device=device) - 1)))
-            # H, _, _ = calculate_hurst_exponent(sub_flow, device)
+        vtm = var_ / mean_
+        ptm = max_value / mean_
+        b = (var_ - mean_) / (mean_ + var_)
+        a = (np.sqrt(n + 1) * vtm - np.sqrt(n - 1)) / ((np.sqrt(n + 1) - 2) * vtm + np.sqrt(n - 1))
+        # H, _, _ = calculate_hurst_exponent(sub_flow, device)
 
         if len(flow) < 2:
             duration = 0
@@ -422,9 +405,7 @@ def analysis_gpu(file_path: str, save_path: str, aggr=1000, consecutive_zeros=50
 
             duration = duration.total_seconds()
 
-        nFlow_data = [packet_count, byte_count.item(), duration, torch.tensor(ptm).mean().item(),
-                      torch.tensor(vtm).mean().item(),
-                      torch.tensor(b).mean().item(), torch.tensor(a).mean().item(), p, 0, 0]
+        nFlow_data = [packet_count, byte_count.item(), duration, ptm.mean(), vtm.mean(), b.mean(), a.mean(), p, 0, 0]
         flow_data.append(nFlow_data)
 
         if len(flow_data) % 1000 == 0:
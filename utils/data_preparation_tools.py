@@ -1,54 +1,60 @@
 import math
+import multiprocessing
 import pickle
 import random
 import re
+import socket
+import struct
 import subprocess
 import sys
+from functools import partial
 from itertools import chain
 
 import numpy as np
 import torch
 from scapy.layers.http import HTTP
 from scapy.layers.inet import TCP, IP, UDP
+from scapy.layers.l2 import Ether
 from scapy.packet import Packet
 from scapy.plist import PacketList
-from scapy.utils import rdpcap
+from scapy.utils import rdpcap, PcapReader
 from torch import tensor
 
+from utils.flow_store import FlowColumns, FlowStore, PROTOCOLS, load_flows, save_flows, flow_packets, sort_flow, \
+    _flags_code
+from utils.tools import available_cpus
+
 
 def create_test_from_full(file_path: str, save_path: str, filter_prot: str = 'TCP', amount: int = 10,
                           shuffle=False):  # options HTTP, TPC, None=Nothing
     print(f"[+] Loading flows from file with location: {file_path} ...")
 
-    with open(file_path, 'rb') as f:
-        data = pickle.load(f)
+    data = load_flows(file_path)
 
     keys = list(data.keys())
 
     if filter_prot == 'TCP':
         keys = [k for k in keys if k[0].startswith('TCP')]
     elif filter_prot == 'HTTP':
-        keys = [k for k in keys if
-                any(packet[3] == "HTTP" for packet in data[k])]  # check if one packet has http layer in the flow
+        if isinstance(data, FlowStore):
+            keys = [k for k in keys if (data.column(k, 'protocol') == PROTOCOLS.index('HTTP')).any()]
+        else:
+            keys = [k for k in keys if
+                    any(packet[3] == "HTTP" for packet in data[k])]  # check if one packet has http layer in the flow
         print(len(keys))
 
     print(f"[+] Found {len(keys)} flows with filter {filter_prot}.")
 
     if not shuffle:
-        keys = sorted(keys, key=lambda k: sum([p[1] for p in data[k]]), reverse=True)
+        keys = sorted(keys, key=lambda k: flow_packets(data[k])[:, 1].sum(), reverse=True)
     else:
         random.shuffle(keys)
 
     keys = keys[:amount]
-    res_data = {}
-
-    for key in keys:
-        res_data[key] = data[key]
 
+    print(f"[+] Saving top {len(keys)} flows in location: {save_path} ...")
+    save_flows(data, save_path, keys=keys)
     data = None
-    print(f"[+] Saving top {len(res_data)} flows in location: {save_path} ...")
-    with open(save_path, 'wb') as f:
-        pickle.dump(res_data, f)
 
     print(f"[x] Saved ...")
 
@@ -71,15 +77,7 @@ def parse_pcap_to_list_n(paths: list, save_path: str):
             with open(save_path, 'rb') as f:
                 data_flows = pickle.load(f)
 
-            for key, value in ndata_flows.items():
-                if key in data_flows:
-                    data_flows[key] += value
-                    merge_counter += 1
-                elif tuple(reversed(key)) in data_flows:
-                    data_flows[tuple(reversed(key))] += value
-                    merge_counter += 1
-                else:
-                    data_flows[key] = value
+            merge_counter = merge_flows(data_flows, ndata_flows)
 
             # for key, value in ndata_flows.items():
             #     if key in data_flows or tuple(reversed(key)) in data_flows:
@@ -106,6 +104,294 @@ def parse_pcap_to_list_n(paths: list, save_path: str):
     print(f"[+] Wrote {size} flows successfully in file with path {save_path}")
 
 
+def merge_flows(data_flows: dict, ndata_flows: dict) -> int:
+    # adds the flows of ndata_flows to data_flows (forward or reverse key) - returns the amount of merged flows
+    merge_counter = 0
+
+    for key, value in ndata_flows.items():
+        if key in data_flows:
+            data_flows[key] += value
+            merge_counter += 1
+        elif tuple(reversed(key)) in data_flows:
+            data_flows[tuple(reversed(key))] += value
+            merge_counter += 1
+        else:
+            data_flows[key] = value
+
+    return merge_counter
+
+
+def _parse_pcap_file(path: str, parser: str = 'raw') -> dict:
+    if parser == 'raw':
+        return split_data_raw(path)
+    elif parser == 'stream':
+        with PcapReader(path) as reader:
+            return split_data_stream(reader)
+    return split_data(rdpcap(path).sessions())
+
+
+def parse_pcap_to_list_parallel(paths: list, save_path: str, parser: str = 'raw', processes: int = None):
+    """Parses every pcap file in its own worker process (parser: scapy, stream or raw) into a partial flow table.
+    The partial tables are merged in the order of paths like in parse_pcap_to_list_n and written once.
+    """
+    print(f"[+] Loading packets from pcap files with location: {paths} ({parser}, parallel) ...")
+
+    data_flows = {}
+
+    with multiprocessing.Pool(processes or available_cpus()) as pool:
+        for path, ndata_flows in zip(paths, pool.imap(partial(_parse_pcap_file, parser=parser), paths)):
+            merge_counter = merge_flows(data_flows, ndata_flows)
+            print(f"[x] Finished {path}. Found {len(data_flows)} flows total - merged {merge_counter}.")
+
+    for k, v in data_flows.items():
+        sort_flow(v)
+
+    save_flows(data_flows, save_path)
+
+    print(f"[+] Wrote {len(data_flows)} flows successfully in file with path {save_path}")
+
+
+def parse_pcap_to_list_stream(paths: list, save_path: str):
+    """Streaming variant of parse_pcap_to_list_n.
+    Packets are read one at a time with a PcapReader and added to the flow table directly, so no capture is ever
+    held in memory as a whole. The flow table is shared over all files and written once at the end - it keeps the
+    numeric columns of every packet (about 17 bytes, see FlowColumns) until then, so memory still grows with the
+    number of packets.
+    """
+    print(f"[+] Streaming packets from pcap files with location: {paths} ...")
+
+    data_flows = {}
+
+    for path in paths:
+        size = len(data_flows)
+
+        with PcapReader(path) as reader:
+            split_data_stream(reader, flows=data_flows)
+
+        print(f"[x] Finished {path}. Found {len(data_flows)} flows total - new {len(data_flows) - size}. "
+              f"Start loading next...")
+
+    for k, v in data_flows.items():
+        sort_flow(v)
+
+    save_flows(data_flows, save_path)
+
+    print(f"[+] Wrote {len(data_flows)} flows successfully in file with path {save_path}")
+
+
+def parse_pcap_to_list_raw(paths: list, save_path: str, chunk_size: int = 1000000):
+    """Same as parse_pcap_to_list_stream but decodes the Ethernet/IPv4/TCP/UDP headers directly from the pcap
+    records instead of dissecting every packet with scapy.
+    """
+    print(f"[+] Loading packets from pcap files with location: {paths} (raw) ...")
+
+    data_flows = {}
+
+    for path in paths:
+        size = len(data_flows)
+        split_data_raw(path, flows=data_flows, chunk_size=chunk_size)
+        print(f"[x] Finished {path}. Found {len(data_flows)} flows total - new {len(data_flows) - size}. "
+              f"Start loading next...")
+
+    for k, v in data_flows.items():
+        sort_flow(v)
+
+    save_flows(data_flows, save_path)
+
+    print(f"[+] Wrote {len(data_flows)} flows successfully in file with path {save_path}")
+
+
+def _get_connection_id(flows: dict, forward_connection_id: tuple, new_flow=list) -> tuple:
+    # a flow is stored under the key of the direction that was seen first
+    if forward_connection_id in flows:
+        return forward_connection_id
+    elif tuple(reversed(forward_connection_id)) in flows:
+        return tuple(reversed(forward_connection_id))
+
+    flows[forward_connection_id] = new_flow()
+    if len(flows) % 100 == 0:
+        print(f"[+] \t Added new socket-to-socket connection: {len(flows)}")
+    return forward_connection_id
+
+
+def _parse_packet(packet: Packet):
+    # same sessions as PacketList.sessions() - only TCP/UDP over IPv4 is kept by split_data
+    if Ether not in packet or IP not in packet:
+        return None
+
+    if TCP in packet:
+        protocol, layer = 'TCP', packet[TCP]
+    elif UDP in packet:
+        protocol, layer = 'UDP', packet[UDP]
+    else:
+        return None
+
+    return protocol, packet[IP].src, str(layer.sport), packet[IP].dst, str(layer.dport)
+
+
+def split_data_stream(packets, flows: dict = None) -> dict:
+    # the packets of every flow are kept as FlowColumns, so only the numeric columns of each packet are retained
+    if flows is None:
+        flows = {}
+
+    counter = 0
+
+    for packet in packets:
+        res = _parse_packet(packet)
+        counter += 1
+
+        if res is None:
+            continue
+
+        protocol, sip, sport, dip, dport = res
+        forward_connection_id = (f"{protocol}|{sip}|{sport}", f"{protocol}|{dip}|{dport}")
+        connection_id = _get_connection_id(flows, forward_connection_id, FlowColumns)
+
+        flows[connection_id].append(float(packet.time), len(packet),
+                                    0 if connection_id == forward_connection_id else 1,
+                                    PROTOCOLS.index(protocol if HTTP not in packet else 'HTTP'),
+                                    0 if TCP not in packet else _flags_code(packet[TCP].flags))
+
+        if counter % 1000000 == 0:
+            print(f"[+] Packets loaded: {counter}")
+
+    return flows
+
+
+PCAP_MAGIC = {  # magic number -> (byte order, fraction of a second of the timestamp)
+    b'\xd4\xc3\xb2\xa1': ('<', 1e6),
+    b'\xa1\xb2\xc3\xd4': ('>', 1e6),
+    b'\x4d\x3c\xb2\xa1': ('<', 1e9),
+    b'\xa1\xb2\x3c\x4d': ('>', 1e9),
+}
+LINKTYPE_ETHERNET = 1
+TCP_FLAG_NAMES = ["".join(f for i, f in enumerate("FSRPAUECN") if code >> i & 1) for code in range(512)]
+HTTP_PORTS = (80, 8080)  # ports scapy binds the HTTP layer to
+
+
+def _read_uint(buf: np.ndarray, idx: np.ndarray, size: int, byteorder: str = '>') -> np.ndarray:
+    # reads unsigned integers of size bytes at the positions idx of buf
+    order = range(size) if byteorder == '>' else reversed(range(size))
+    res = np.zeros(len(idx), dtype=np.uint64)
+    for i in order:
+        res = (res << np.uint64(8)) | buf[idx + i]
+    return res
+
+
+def _pcap_record_offsets(buf: np.ndarray, byteorder: str) -> np.ndarray:
+    # records have a variable length - only the record headers are walked here, everything else is vectorized
+    record_len = struct.Struct(byteorder + 'I')
+    offsets = []
+    offset = 24
+    end = len(buf) - 16
+
+    while offset <= end:
+        offsets.append(offset)
+        offset += 16 + record_len.unpack_from(buf, offset + 8)[0]
+
+    if offset > len(buf):  # last record is truncated
+        offsets.pop()
+
+    return np.array(offsets, dtype=np.int64)
+
+
+def _decode_records(buf: np.ndarray, offsets: np.ndarray, byteorder: str, frac: float) -> dict:
+    ts_sec = _read_uint(buf, offsets, 4, byteorder)
+    ts_frac = _read_uint(buf, offsets + 4, 4, byteorder)
+    caplen = _read_uint(buf, offsets + 8, 4, byteorder).astype(np.int64)
+
+    if frac == 1e6:  # integer microseconds are exact in float64 so this equals float(packet.time)
+        times = (ts_sec * np.uint64(1000000) + ts_frac).astype(np.float64) / frac
+    else:
+        times = ts_sec.astype(np.float64) + ts_frac.astype(np.float64) / frac
+
+    # Ethernet (optionally with one 802.1Q tag)
+    data = offsets + 16
+    valid = caplen >= 14 + 20
+    eth_type = _read_uint(buf, np.where(valid, data + 12, 0), 2)  # invalid records read from offset 0 instead
+    vlan = valid & (eth_type == 0x8100)
+    eth_type = np.where(vlan, _read_uint(buf, np.where(vlan, data + 16, 0), 2), eth_type)
+    l3 = data + np.where(vlan, 18, 14)
+    valid &= (eth_type == 0x0800) & (caplen >= l3 - data + 20)
+
+    # IPv4
+    l3 = np.where(valid, l3, 0)
+    version_ihl = buf[l3]
+    ihl = (version_ihl & 0x0F).astype(np.int64) * 4
+    ip_len = _read_uint(buf, l3 + 2, 2).astype(np.int64)
+    frag = _read_uint(buf, l3 + 6, 2) & 0x1FFF
+    proto = buf[l3 + 9]
+    valid &= (version_ihl >> 4 == 4) & (frag == 0) & ((proto == 6) | (proto == 17))
+
+    # TCP / UDP
+    l4 = l3 + ihl
+    valid &= caplen >= l4 - data + np.where(proto == 6, 20, 8)
+    l4 = np.where(valid, l4, 0)
+    sport = _read_uint(buf, l4, 2)
+    dport = _read_uint(buf, l4 + 2, 2)
+
+    is_tcp = valid & (proto == 6)
+    l4_tcp = np.where(is_tcp, l4, 0)  # only 8 bytes of a UDP header are checked, these would read past short records
+    doff = np.where(is_tcp, (buf[l4_tcp + 12] >> 4).astype(np.int64) * 4, 0)
+    flags = np.where(is_tcp, _read_uint(buf, l4_tcp + 12, 2) & 0x01FF, 0).astype(np.int64)
+    payload = np.minimum(ip_len, caplen - (l3 - data)) - ihl - doff
+    is_http = is_tcp & (payload > 0) & (np.isin(sport, HTTP_PORTS) | np.isin(dport, HTTP_PORTS))
+
+    return {'valid': valid, 'time': times, 'length': caplen, 'tcp': is_tcp, 'http': is_http, 'flags': flags,
+            'src': _read_uint(buf, l3 + 12, 4), 'dst': _read_uint(buf, l3 + 16, 4), 'sport': sport, 'dport': dport}
+
+
+def split_data_raw(path: str, flows: dict = None, chunk_size: int = 1000000) -> dict:
+    if flows is None:
+        flows = {}
+
+    buf = np.memmap(path, dtype=np.uint8, mode='r')
+
+    if bytes(buf[:4]) not in PCAP_MAGIC:
+        raise ValueError(f"{path} is not a pcap file (pcapng is not supported by the raw parser).")
+
+    byteorder, frac = PCAP_MAGIC[bytes(buf[:4])]
+    link_type = struct.unpack_from(byteorder + 'I', buf, 20)[0]
+
+    if link_type != LINKTYPE_ETHERNET:
+        raise ValueError(f"{path} has link type {link_type} - the raw parser only supports Ethernet.")
+
+    offsets = _pcap_record_offsets(buf, byteorder)
+    print(f"[+] Found {len(offsets)} packets in {path}.")
+
+    for c in range(0, len(offsets), chunk_size):
+        r = _decode_records(buf, offsets[c:c + chunk_size], byteorder, frac)
+        r = {k: v[r['valid']] for k, v in r.items()}
+
+        # sessions in order of their first packet, like PacketList.sessions()
+        session = np.stack((r['tcp'], r['src'], r['sport'], r['dst'], r['dport']), axis=1).astype(np.uint64)
+        _, first, inverse = np.unique(session, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(first[inverse], kind='stable')
+        bounds = np.flatnonzero(np.diff(inverse[order], prepend=-1, append=-1))
+
+        times, lengths = r['time'].tolist(), r['length'].tolist()
+        http, flags = r['http'].tolist(), r['flags'].tolist()
+
+        for s, e in zip(bounds[:-1], bounds[1:]):
+            idx = order[s:e]
+            i = idx[0]
+            protocol = 'TCP' if r['tcp'][i] else 'UDP'
+            sip, dip = socket.inet_ntoa(struct.pack('>I', r['src'][i])), socket.inet_ntoa(struct.pack('>I', r['dst'][i]))
+
+            forward_connection_id = (f"{protocol}|{sip}|{r['sport'][i]}", f"{protocol}|{dip}|{r['dport'][i]}")
+            connection_id = _get_connection_id(flows, forward_connection_id)
+            direction = 0 if connection_id == forward_connection_id else 1
+
+            flows[connection_id].extend([[times[j], lengths[j], direction, 'HTTP' if http[j] else protocol,
+                                          TCP_FLAG_NAMES[flags[j]] if protocol == 'TCP' else ""]
+                                         for j in idx.tolist()])
+
+        print(f"[+] Packets loaded: {min(c + chunk_size, len(offsets)) / len(offsets)}")
+
+    return flows
+
+
 def split_data(sessions: dir):
     flows = {}
 
@@ -139,16 +425,7 @@ def split_data(sessions: dir):
             protocols.add(protocol)
 
         forward_connection_id = (f"{protocol}|{sip}|{sport}", f"{protocol}|{dip}|{dport}")
-
-        if forward_connection_id in flows:
-            connection_id = forward_connection_id
-        elif tuple(reversed(forward_connection_id)) in flows:
-            connection_id = tuple(reversed(forward_connection_id))
-        else:
-            flows[forward_connection_id] = []
-            connection_id = forward_connection_id
-            if len(flows) % 100 == 0:
-                print(f"[+] \t Added new socket-to-socket connection: {len(flows)}")
+        connection_id = _get_connection_id(flows, forward_connection_id)
 
         flows[connection_id].extend(list(map(lambda packet: [float(packet.time), len(packet),
                                                              0 if connection_id == forward_connection_id else 1,
@@ -165,36 +442,89 @@ def split_data(sessions: dir):
 
 
 def split_tensor_gpu(tensor_, consecutive_zeros):
-    # step 1: identify Zero Sequences
-    # create a mask of zeros and find the difference between consecutive elements
-    is_zero = tensor_[:, 1] == 0
-    diff = torch.diff(is_zero.float(), prepend=torch.tensor([0.0], device=tensor_.device))
+    starts, ends = split_tensor_gpu_offsets(tensor_[:, 1], consecutive_zeros)
+    return [tensor_[s:e] for s, e in zip(starts.tolist(), ends.tolist())]
 
-    # start and end indices of zero sequences
-    start_indices = torch.where(diff == 1)[0]
-    end_indices = torch.where(diff == -1)[0]
 
-    # adjust for cases where sequences reach the end of the tensor
-    if len(end_indices) == 0 or (len(start_indices) > 0 and end_indices[-1] < start_indices[-1]):
-        end_indices = torch.cat([end_indices, tensor_.size(0) * torch.ones(1, dtype=torch.long, device=tensor_.device)])
+def split_tensor_gpu_offsets(series: torch.Tensor, consecutive_zeros: int):
+    # splits series (1-d) at zero sequences longer than consecutive_zeros (keeping consecutive_zeros of the zeros).
+    # returns the start and end indices of the sequences - the sequences are series[starts[i]:ends[i]]
+    if series.shape[0] == 0:
+        return torch.zeros(0, dtype=torch.long, device=series.device), torch.zeros(0, dtype=torch.long,
+                                                                                  device=series.device)
 
-    # step 2: mark split points
-    # find sequences with length >= consecutive_zeros
-    valid_seqs = (end_indices - start_indices) > consecutive_zeros
-    valid_start_indices = start_indices[valid_seqs] + consecutive_zeros  # 0:st+2
-    valid_end_indices = end_indices[valid_seqs]
+    series_offsets = torch.tensor([0, series.shape[0]], device=series.device)
+    starts, ends = split_segments_gpu(series, series_offsets, consecutive_zeros)
 
-    splits = []
-    end_idx = 0
-    for i in range(len(valid_start_indices)):
-        splits.append(tensor_[end_idx:valid_start_indices[i]])
-        end_idx = valid_end_indices[i]
+    keep = starts < series.shape[0]  # nothing remains if the series ends with a split
+    return starts[keep], ends[keep]
 
-    # add the remaining part of the tensor if any
-    if end_idx < tensor_.size(0):
-        splits.append(tensor_[end_idx:])
 
-    return splits
+def aggregate_flows_gpu(packets: torch.Tensor, packet_offsets: torch.Tensor, aggr: int):
+    # bins the packets of many flows with one scatter-add - packets: [n, 2] (time, length) of all flows concatenated
+    # (each ordered by time), packets of flow i at packet_offsets[i]:packet_offsets[i + 1]
+    device = packets.device
+    counts = packet_offsets[1:] - packet_offsets[:-1]
+    flow_ids = torch.repeat_interleave(torch.arange(len(counts), device=device), counts)
+
+    start_times = (packets[packet_offsets[:-1], 0] * aggr).long()
+    end_times = (packets[packet_offsets[1:] - 1, 0] * aggr).long() + 1
+
+    series_offsets = torch.zeros(len(counts) + 1, dtype=torch.long, device=device)
+    series_offsets[1:] = torch.cumsum(end_times - start_times + 1, dim=0)
+
+    series = torch.zeros(int(series_offsets[-1]), device=device, dtype=packets.dtype)
+    packet_times = ((packets[:, 0] * aggr) - start_times[flow_ids]).long() + series_offsets[flow_ids]
+    series.index_add_(0, packet_times, packets[:, 1])
+
+    return series, series_offsets, start_times
+
+
+def reduce_series_gpu(series: torch.Tensor, series_offsets: torch.Tensor, start_times: torch.Tensor, factor: int):
+    # sums blocks of factor bins of the output of aggregate_flows_gpu - gives the series of aggr / factor. The blocks
+    # are aligned to the absolute time like int(time * aggr / factor)
+    device = series.device
+    lengths = series_offsets[1:] - series_offsets[:-1]
+
+    reduced_start_times = torch.div(start_times, factor, rounding_mode='floor')
+    reduced_lengths = torch.div(start_times + lengths - 2, factor, rounding_mode='floor') + 2 - reduced_start_times
+
+    reduced_offsets = torch.zeros_like(series_offsets)
+    reduced_offsets[1:] = torch.cumsum(reduced_lengths, dim=0)
+
+    bins = torch.nonzero(series).flatten()
+    flow_ids = torch.searchsorted(series_offsets, bins, right=True) - 1
+    reduced_bins = torch.div(start_times[flow_ids] + bins - series_offsets[flow_ids], factor, rounding_mode='floor')
+
+    reduced = torch.zeros(int(reduced_offsets[-1]), device=device, dtype=series.dtype)
+    reduced.index_add_(0, reduced_bins - reduced_start_times[flow_ids] + reduced_offsets[flow_ids], series[bins])
+
+    return reduced, reduced_offsets, reduced_start_times
+
+
+def split_segments_gpu(series: torch.Tensor, series_offsets: torch.Tensor, consecutive_zeros: int):
+    # split_tensor_gpu for all flows of a flat series at once - zero sequences never cross flow borders.
+    # returns the start and end indices of the sequences in series
+    device = series.device
+    is_zero = series == 0
+
+    flow_start = torch.zeros_like(is_zero)
+    flow_start[series_offsets[:-1]] = True
+    flow_end = torch.zeros_like(is_zero)
+    flow_end[series_offsets[1:] - 1] = True
+
+    no_zero = torch.zeros(1, dtype=torch.bool, device=device)
+    prev_zero = torch.cat((no_zero, is_zero[:-1])) & ~flow_start
+    next_zero = torch.cat((is_zero[1:], no_zero)) & ~flow_end
+
+    zero_starts = torch.where(is_zero & ~prev_zero)[0]
+    zero_ends = torch.where(is_zero & ~next_zero)[0] + 1
+
+    valid_seqs = (zero_ends - zero_starts) > consecutive_zeros
+    starts = torch.sort(torch.cat((series_offsets[:-1], zero_ends[valid_seqs]))).values
+    ends = torch.sort(torch.cat((zero_starts[valid_seqs] + consecutive_zeros, series_offsets[1:]))).values
+
+    return starts, ends
 
 
 def split_by(tuples: list, percentages) -> list[dir]:
@@ -219,6 +549,28 @@ def split_by(tuples: list, percentages) -> list[dir]:
     return splits
 
 
+def split_counts(counts, percentages) -> list[tuple]:
+    # like split_by, but on the number of elements per group - returns the (begin, end) group borders of each split
+    segments = [int(sum(counts) * per) for per in percentages]
+
+    borders = []
+    begin = 0
+    current_len = 0
+
+    for i, count in enumerate(counts):
+        current_len += count
+
+        if current_len >= segments[len(borders)]:
+            borders.append((begin, i + 1))
+            begin = i + 1
+            current_len = 0
+            assert len(borders) <= len(segments)
+
+    if begin != len(counts):
+        borders.append((begin, len(counts)))
+    return borders
+
+
 def test_split_tensor(func):
     def are_lists_of_tensors_equal(list1, list2):
         if len(list1) != len(list2):
@@ -0,0 +1,219 @@
+import os
+import pickle
+from array import array
+from collections.abc import Mapping
+from functools import partial
+
+import numpy as np
+
+PROTOCOLS = ['TCP', 'UDP', 'HTTP']
+TCP_FLAGS = "FSRPAUECN"
+COLUMNS = {'time': np.float64, 'length': np.uint32, 'direction': np.uint8, 'protocol': np.uint8, 'flags': np.uint16}
+
+
+def _flags_code(flags) -> int:
+    # scapy FlagValue, flag string of the raw parser or "" for UDP
+    if isinstance(flags, str):
+        return sum(1 << TCP_FLAGS.index(f) for f in flags)
+    return int(flags)
+
+
+def _flags_name(code: int) -> str:
+    return "".join(f for i, f in enumerate(TCP_FLAGS) if code >> i & 1)
+
+
+class FlowColumns:
+    """Packets of one flow while parsing, kept in compact numeric columns (about 16 bytes per packet) instead of the
+    record lists of the pickled dict. The columns and their codes are the ones of FlowStore."""
+
+    __slots__ = tuple(COLUMNS)
+    TYPECODES = {'time': 'd', 'length': 'I', 'direction': 'B', 'protocol': 'B', 'flags': 'H'}
+
+    def __init__(self):
+        for c in COLUMNS:
+            setattr(self, c, array(self.TYPECODES[c]))
+
+    def __len__(self):
+        return len(self.time)
+
+    def __iadd__(self, other):
+        for c in COLUMNS:
+            getattr(self, c).extend(getattr(other, c))
+        return self
+
+    def __getstate__(self):
+        return {c: getattr(self, c) for c in COLUMNS}
+
+    def __setstate__(self, state):
+        for c in COLUMNS:
+            setattr(self, c, state[c])
+
+    def append(self, time: float, length: int, direction: int, protocol: int, flags: int):
+        self.time.append(time)
+        self.length.append(length)
+        self.direction.append(direction)
+        self.protocol.append(protocol)
+        self.flags.append(flags)
+
+    def sort(self):
+        # stable by time like list.sort(key=lambda t: t[0]) on the records
+        order = np.argsort(np.frombuffer(self.time, dtype=np.float64), kind='stable')
+        for c in COLUMNS:
+            column = getattr(self, c)
+            setattr(self, c, array(column.typecode, np.asarray(column)[order].tobytes()))
+
+    def columns(self) -> dict:
+        return {c: np.asarray(getattr(self, c)) for c in COLUMNS}
+
+    def iter_records(self):
+        # packets one at a time in the format of the pickled dict
+        for t, l, d, p, f in zip(*[getattr(self, c) for c in COLUMNS]):
+            yield [t, l, d, PROTOCOLS[p], "" if PROTOCOLS[p] == 'UDP' else _flags_name(f)]
+
+    def records(self) -> list:
+        # flow in the format of the pickled dict
+        return list(self.iter_records())
+
+
+class _LazyRecords:
+    """Records of one flow that are only created while it is pickled and unpickled as the list of records, so
+    save_flows never holds the records of all flows at once"""
+
+    __slots__ = ('records',)
+
+    def __init__(self, records):
+        self.records = records  # callable returning an iterable of the records
+
+    def __reduce__(self):
+        return list, (), None, iter(self.records())
+
+
+def sort_flow(flow):
+    # packets of a flow of the flow table in order of their time
+    if isinstance(flow, FlowColumns):
+        flow.sort()
+    else:
+        flow.sort(key=lambda t: t[0])
+
+
+class FlowStore(Mapping):
+    """Columnar flow storage.
+    All packets of all flows are stored in flat arrays (time, length, direction, protocol, flags) that are memory
+    mapped from a directory. The packets of flow i are at offsets[i]:offsets[i + 1] and its key is keys[i].
+    Indexing with a key returns a [n, 3] array of [time, length, direction] which are the numeric columns of the
+    records in the pickled dict.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.columns = {c: np.load(os.path.join(path, f'{c}.npy'), mmap_mode='r') for c in COLUMNS}
+        self.index = {tuple(k): i for i, k in enumerate(np.load(os.path.join(path, 'keys.npy')).tolist())}
+
+    def __getitem__(self, key) -> np.ndarray:
+        s, e = self._bounds(key)
+        return np.stack((self.columns['time'][s:e], self.columns['length'][s:e], self.columns['direction'][s:e]),
+                        axis=1).astype(np.float64)
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def _bounds(self, key) -> tuple:
+        i = self.index[key]
+        return self.offsets[i], self.offsets[i + 1]
+
+    def column(self, key, name: str) -> np.ndarray:
+        s, e = self._bounds(key)
+        return self.columns[name][s:e]
+
+    def packet_count(self, key) -> int:
+        s, e = self._bounds(key)
+        return int(e - s)
+
+    def records(self, key) -> list:
+        # flow in the format of the pickled dict
+        s, e = self._bounds(key)
+        return [[t, l, d, PROTOCOLS[p], "" if PROTOCOLS[p] == 'UDP' else _flags_name(f)] for t, l, d, p, f in
+                zip(*[self.columns[c][s:e].tolist() for c in COLUMNS])]
+
+    @staticmethod
+    def write(path: str, flows):
+        # flows: iterable of (key, dict of columns)
+        os.makedirs(path, exist_ok=True)
+
+        keys = []
+        columns = {c: [] for c in COLUMNS}
+
+        for key, cols in flows:
+            keys.append(key)
+            for c in COLUMNS:
+                columns[c].append(np.asarray(cols[c], dtype=COLUMNS[c]))
+
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in columns['time']])
+
+        for c, dtype in COLUMNS.items():
+            np.save(os.path.join(path, f'{c}.npy'), np.concatenate(columns[c]) if keys else np.zeros(0, dtype=dtype))
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        np.save(os.path.join(path, 'keys.npy'), np.array(keys, dtype=str).reshape(-1, 2))
+
+
+def _record_columns(records: list) -> dict:
+    t, l, d, p, f = zip(*records) if records else ([],) * 5
+    return {'time': t, 'length': l, 'direction': d, 'protocol': [PROTOCOLS.index(x) for x in p],
+            'flags': [_flags_code(x) for x in f]}
+
+
+def is_flow_store(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, 'offsets.npy'))
+
+
+def load_flows(path: str):
+    # returns a FlowStore for flow store directories and the pickled dict otherwise
+    if is_flow_store(path):
+        print(f"[+] Opening flow store with location: {path} ...")
+        return FlowStore(path)
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def save_flows(data_flows, save_path: str, keys: list = None):
+    # writes the flows (dict or FlowStore) as pickle if save_path ends with .pkl and as flow store otherwise
+    keys = list(data_flows.keys()) if keys is None else keys
+    store = isinstance(data_flows, FlowStore)
+
+    def records(k):
+        if store:
+            return _LazyRecords(partial(data_flows.records, k))
+        return _LazyRecords(data_flows[k].iter_records) if isinstance(data_flows[k], FlowColumns) else data_flows[k]
+
+    def columns(k):
+        if store:
+            return {c: data_flows.column(k, c) for c in COLUMNS}
+        return data_flows[k].columns() if isinstance(data_flows[k], FlowColumns) else _record_columns(data_flows[k])
+
+    if save_path.endswith('.pkl'):
+        with open(save_path, 'wb') as f:
+            pickler = pickle.Pickler(f)
+            pickler.fast = True  # no memo, it would keep every pickled record alive until the end
+            pickler.dump({k: records(k) for k in keys})
+    else:
+        FlowStore.write(save_path, ((k, columns(k)) for k in keys))
+
+
+def flow_packets(flow, columns: int = 2) -> np.ndarray:
+    # [n, columns] float64 array of [time, length, direction] for a flow of a FlowStore or of the pickled dict
+    if isinstance(flow, np.ndarray):
+        return flow[:, :columns]
+    return np.array([x[:columns] for x in flow], dtype=np.float64).reshape(-1, columns)
+
+
+def convert_pickle_to_flow_store(file_path: str, save_path: str):
+    print(f"[+] Converting flows from file with location: {file_path} ...")
+    data_flows = load_flows(file_path)
+    save_flows(data_flows, save_path)
+    print(f"[+] Wrote {len(data_flows)} flows successfully in flow store with path {save_path}")
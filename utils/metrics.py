@@ -1,5 +1,6 @@
 import numpy as np
-from scipy.stats import stats
+import torch
+from scipy import stats
 from sklearn.preprocessing import StandardScaler
 
 
@@ -34,44 +35,15 @@ def MSPE(pred, true):
 
 
 def HVI(pred, true, interval=10):
-    error = []
-    for i in list(range(len(pred))):
-        pred_peak_index = pred[i].argmax()
-        pred_peak_value = pred[i, pred_peak_index]
+    # pred = true = [B,P,C] or [B,P]
+    return hvi_errors(pred, true, interval).mean()
 
-        true_peak_index = true[i,
-                          max(pred_peak_index - interval, 0): min(pred_peak_index + interval, true.shape[1])].argmax()
-        true_peak_value = true[i, true_peak_index]
 
-        true_actual_peak_index = true[i].argmax()
-        true_actual_peak_value = true[i, true_actual_peak_index]
-
-        error.append((pred_peak_value - true_peak_value) / true_actual_peak_value)
-
-    return np.array(error).mean()
-
-
-def pearson(context, pred, true):  # context = [B,L,1]; pred = true = [B,P,1]
-    residual = (pred - true).squeeze(axis=-1)
-    context = context.squeeze(axis=-1)
-    true = true.squeeze(axis=-1)
-    pred = pred.squeeze(axis=-1)
-    prs = 0
-    pts = 0
-
-    for i in range(context.shape[1]):
-        c = context[:, i]
-        for j in range(residual.shape[1]):
-            cr, pr = stats.pearsonr(c, residual[:, j])
-            ct, pt = stats.pearsonr(c, true[:, j])
-
-            if pr < 0.01 and pt < 0.01:
-                prs += cr
-                pts += ct
-
-        print(f"[x] Processing pearson: {i / context.shape[1]}")
-
-    return prs, pts
+def pearson(context, pred, true, chunk_size=65536):  # context = [B,L,1]; pred = true = [B,P,1]
+    accumulator = PearsonAccumulator()
+    for i in range(0, len(context), chunk_size):
+        accumulator.update(*(torch.as_tensor(np.asarray(x[i:i + chunk_size])) for x in (context, pred, true)))
+    return accumulator.compute()
 
 
 def metric(pred, true):
@@ -83,3 +55,156 @@ def metric(pred, true):
     hvi = HVI(pred, true)
 
     return mae, mse, rmse, mape, mspe, hvi
+
+
+def hvi_errors(pred, true, interval=10):
+    """Peak errors of HVI for every sample and channel of pred = true = [B,P,C] (numpy arrays or torch tensors):
+    the predicted peak against the highest true value within interval steps around it, relative to the true peak"""
+    if pred.ndim == 2:
+        return hvi_errors(pred[..., None], true[..., None], interval)[..., 0]
+
+    if isinstance(pred, torch.Tensor):
+        pred_peak_index = pred.argmax(dim=1, keepdim=True)  # [B,1,C]
+        pred_peak_value = pred.gather(1, pred_peak_index).squeeze(1)
+
+        steps = pred_peak_index + torch.arange(-interval, interval, device=pred.device).view(1, -1, 1)
+        window = true.gather(1, steps.clamp(0, true.shape[1] - 1))
+        true_peak_value = window.masked_fill((steps < 0) | (steps >= true.shape[1]), -torch.inf).amax(dim=1)
+
+        return (pred_peak_value - true_peak_value) / true.amax(dim=1)
+
+    pred_peak_index = pred.argmax(axis=1)[:, None]
+    pred_peak_value = np.take_along_axis(pred, pred_peak_index, axis=1)[:, 0]
+
+    # true values of the steps [peak - interval, peak + interval) around the predicted peaks
+    steps = pred_peak_index + np.arange(-interval, interval).reshape(1, -1, 1)
+    window = np.take_along_axis(true, steps.clip(0, true.shape[1] - 1), axis=1)
+    true_peak_value = np.where((steps < 0) | (steps >= true.shape[1]), -np.inf, window).max(axis=1)
+
+    return (pred_peak_value - true_peak_value) / true.max(axis=1)
+
+
+class MetricAccumulator:
+    """Running sums of the metrics of metric() that are updated with every batch on the device of the batch, so
+    neither the predictions have to be kept nor the device has to be synchronized before compute()."""
+
+    names = ['mae', 'mse', 'rmse', 'mape', 'mspe', 'hvi']
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.sums = None
+        self.count = 0
+        self.samples = 0
+
+    @torch.no_grad()
+    def update(self, pred, true):
+        pred, true = pred.detach().float(), true.detach().float()
+        error = pred - true
+        relative = error / true
+        hvi = hvi_errors(pred, true, self.interval)
+
+        sums = torch.stack([error.abs().sum(), error.square().sum(), relative.abs().sum(), relative.square().sum(),
+                            hvi.sum()]).double()
+        self.sums = sums if self.sums is None else self.sums + sums
+        self.count += error.numel()
+        self.samples += hvi.numel()
+
+    def compute(self):
+        if self.sums is None:
+            return tuple(np.nan for _ in self.names)
+
+        mae, mse, mape, mspe, hvi = (self.sums.cpu().numpy() /
+                                     [self.count, self.count, self.count, self.count, self.samples]).tolist()
+        return mae, mse, float(np.sqrt(mse)), mape, mspe, hvi
+
+    def results(self, prefix=''):
+        return {f'{prefix}{name}': value for name, value in zip(self.names, self.compute())}
+
+
+class TrajectoryReservoir:
+    """Uniform random sample of at most size (true, pred) trajectories of all batches (reservoir sampling). Only the
+    sampled trajectories of a batch are copied from the device."""
+
+    def __init__(self, size=64, seed=1012):
+        self.size = size
+        self.rng = np.random.default_rng(seed)
+        self.seen = 0
+        self.trues = None
+        self.preds = None
+
+    def update(self, true, pred):
+        n = true.shape[0]
+        positions = np.arange(self.seen, self.seen + n)
+        slots = np.where(positions < self.size, positions, self.rng.integers(0, positions + 1))
+        self.seen += n
+
+        rows = np.nonzero(slots < self.size)[0]
+        if len(rows) == 0:
+            return
+
+        # a later trajectory replaces an earlier one of the same batch in the same slot
+        slots, last = np.unique(slots[rows][::-1], return_index=True)
+        rows = rows[::-1][last]
+
+        if self.trues is None:
+            self.trues = np.empty((self.size,) + tuple(true.shape[1:]), dtype=np.float32)
+            self.preds = np.empty((self.size,) + tuple(pred.shape[1:]), dtype=np.float32)
+        index = torch.as_tensor(rows, device=true.device)
+        self.trues[slots] = true.detach()[index].float().cpu().numpy()
+        self.preds[slots] = pred.detach()[index].float().cpu().numpy()
+
+    def items(self):
+        filled = min(self.seen, self.size)
+        return list(zip(self.trues[:filled], self.preds[:filled])) if filled else []
+
+
+class PearsonAccumulator:
+    """Correlations of every context step with the residual and the true value of every horizon step, streamed over
+    the batches. Only the column sums and the cross products (matmuls of the [B,L] context with the [B,P] residuals
+    and true values) are kept on the device of the batches. compute() returns the sums of the correlations of the
+    pairs where both correlations are significant (p < alpha) as pearson() did with scipy.stats.pearsonr."""
+
+    def __init__(self, alpha=0.01):
+        self.alpha = alpha
+        self.count = 0
+        self.shift = None
+        self.sums = None
+
+    @torch.no_grad()
+    def update(self, context, pred, true):
+        context = context.detach().squeeze(-1).double()
+        true = true.detach().squeeze(-1).double()
+        residual = pred.detach().squeeze(-1).double() - true
+
+        if self.shift is None:  # values are centered with the means of the first batch for numerical stability
+            self.shift = [x.mean(dim=0) for x in (context, residual, true)]
+        context, residual, true = (x - shift for x, shift in zip((context, residual, true), self.shift))
+
+        sums = [context.sum(dim=0), residual.sum(dim=0), true.sum(dim=0),
+                context.square().sum(dim=0), residual.square().sum(dim=0), true.square().sum(dim=0),
+                context.T @ residual, context.T @ true]
+        self.sums = sums if self.sums is None else [a + b for a, b in zip(self.sums, sums)]
+        self.count += len(context)
+
+    def _correlations(self, c, x, cc, xx, cx):
+        n = self.count
+        covariance = cx / n - np.outer(c / n, x / n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = covariance / np.sqrt(np.outer(cc / n - (c / n) ** 2, xx / n - (x / n) ** 2))
+        r = np.clip(r, -1, 1)
+
+        # two-sided p-values of pearsonr, r has a beta distribution on [-1, 1] without correlation
+        a = n / 2 - 1
+        p = 2 * stats.beta.sf(np.abs(r), a, a, loc=-1, scale=2)
+        return r, p
+
+    def compute(self):
+        if self.sums is None or self.count < 3:
+            return 0, 0
+
+        c, r, t, cc, rr, tt, cr, ct = (x.cpu().numpy() for x in self.sums)
+        corr_r, p_r = self._correlations(c, r, cc, rr, cr)
+        corr_t, p_t = self._correlations(c, t, cc, tt, ct)
+
+        significant = (p_r < self.alpha) & (p_t < self.alpha)
+        return corr_r[significant].sum(), corr_t[significant].sum()
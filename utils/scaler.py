@@ -32,6 +32,9 @@ class StandardScalerT:
         self.fit(values)
         return self.transform(values)
 
+    def inverse_transform(self, values):
+        return values * (self.std + self.epsilon) + self.mean
+
 
 class StandardScalerNp:
     def __init__(self, mean=None, std=None, zero_element=None, epsilon=1e-7):
@@ -56,20 +59,41 @@ class StandardScalerNp:
     def inverse_transform(self, values):
         return (values * (self.std + self.epsilon)) + self.mean
 
+    def inverse_transform_array(self, values):
+        return values * float(self.std + self.epsilon) + float(self.mean)
+
 
 class StandardScalerList:
     def __init__(self):
         self.scaler = StandardScaler()
 
     def fit(self, values: list[np.ndarray]):
-        values = np.concatenate(values, axis=0)
-        self.scaler.fit(values)
+        # single pass over the flows merging the count, mean and squared deviations of every flow (Chan et al.) -
+        # the flows are never concatenated
+        n, mean, m2 = 0, 0.0, 0.0
+        for val in values:
+            if len(val) == 0:
+                continue
+            val_mean = np.mean(val, axis=0, dtype=np.float64)
+            val_m2 = np.sum(np.square(val - val_mean), axis=0, dtype=np.float64)
+
+            delta = val_mean - mean
+            total = n + len(val)
+            mean = mean + delta * (len(val) / total)
+            m2 = m2 + val_m2 + np.square(delta) * (n * len(val) / total)
+            n = total
+
+        var = m2 / n
+        scale = np.sqrt(var)
+        scale[scale < 10 * np.finfo(scale.dtype).eps] = 1.0  # constant features like sklearn
 
-    def transform(self, values: list[np.ndarray]):
+        self.load_state_dict({'mean': mean, 'var': var, 'scale': scale, 'n_samples_seen': np.asarray(n)})
+
+    def transform(self, values: list[np.ndarray], inplace: bool = False):
         nValues = []
 
         for val in values:
-            nValues.append(self.scaler.transform(val))
+            nValues.append(self.transform_array(val, out=val) if inplace else self.scaler.transform(val))
 
         return nValues
 
@@ -77,6 +101,39 @@ class StandardScalerList:
         self.fit(values)
         return self.transform(values)
 
+    def state_dict(self) -> dict:
+        return {'mean': self.scaler.mean_, 'var': self.scaler.var_, 'scale': self.scaler.scale_,
+                'n_samples_seen': np.asarray(self.scaler.n_samples_seen_)}
+
+    def load_state_dict(self, state: dict):
+        self.scaler.mean_ = state['mean']
+        self.scaler.var_ = state['var']
+        self.scaler.scale_ = state['scale']
+        self.scaler.n_samples_seen_ = state['n_samples_seen']
+        self.scaler.n_features_in_ = len(state['mean'])
+
+    def save(self, path: str):
+        np.savez(path, **self.state_dict())
+
+    def load(self, path: str):
+        with np.load(path) as state:
+            self.load_state_dict(dict(state))
+
+    def transform_array(self, values: np.ndarray, dtype=None, out: np.ndarray = None):
+        # single array without the checks and copies of sklearn, e.g. a window of a memory mapped flow
+        # out=values scales in place, dtype computes in another precision (e.g. np.float32)
+        mean, scale = self.scaler.mean_, self.scaler.scale_
+
+        if out is not None:
+            np.subtract(values, mean, out=out, casting='unsafe')
+            np.divide(out, scale, out=out, casting='unsafe')
+            return out
+
+        if dtype is not None:
+            values = values.astype(dtype, copy=False)
+            mean, scale = mean.astype(dtype), scale.astype(dtype)
+        return (values - mean) / scale
+
     def inverse_transform_l(self, values):
         nValues = []
 
@@ -88,6 +145,9 @@ class StandardScalerList:
     def inverse_transform(self, values):
         return self.scaler.inverse_transform(values)
 
+    def inverse_transform_array(self, values):
+        return inverse_transform_array(self.scaler, values)
+
 
 class MinMaxScalerNp:
     def __init__(self, min=None, max=None, zero_element=None, epsilon=1e-7):
@@ -112,6 +172,9 @@ class MinMaxScalerNp:
     def inverse_transform(self, values):
         return (values * (self.max - self.min + self.epsilon)) + self.min
 
+    def inverse_transform_array(self, values):
+        return values * float(self.max - self.min + self.epsilon) + float(self.min)
+
 
 class LogScalerNp:
     def fit(self, values: np.ndarray):
@@ -128,6 +191,9 @@ class LogScalerNp:
     def inverse_transform(self, values):
         return np.exp(values)
 
+    def inverse_transform_array(self, values):
+        return torch.exp(values) if isinstance(values, torch.Tensor) else np.exp(values)
+
 
 class RobustScalerNp:
     def __init__(self, mean=None, quantile_75=None, quantile_25=None):
@@ -149,3 +215,21 @@ class RobustScalerNp:
 
     def inverse_transform(self, values):
         return values * (self.quantile_75 - self.quantile_25) + self.mean
+
+    def inverse_transform_array(self, values):
+        return values * float(self.quantile_75 - self.quantile_25) + float(self.mean)
+
+
+def _like(parameter, values):
+    # fitted parameter in the dtype of values (and on the device of a tensor)
+    if isinstance(values, torch.Tensor):
+        return torch.as_tensor(parameter, dtype=values.dtype, device=values.device)
+    return np.asarray(parameter, dtype=values.dtype)
+
+
+def inverse_transform_array(scaler, values):
+    """Inverse of a fitted sklearn StandardScaler or a scaler of this module applied to a whole numpy array or torch
+    tensor with the features as last dimension, e.g. all predictions [N,P,C] at once on their device"""
+    if isinstance(scaler, StandardScaler):
+        return values * _like(scaler.scale_, values) + _like(scaler.mean_, values)
+    return scaler.inverse_transform_array(values)
@@ -0,0 +1,79 @@
+import os
+import pickle
+from collections.abc import Sequence
+
+import numpy as np
+
+META_DTYPE = np.dtype([('start', np.float64), ('aggr', np.int64)])
+
+
+class SequenceStore(Sequence):
+    """Processed sequences of DatatransformerEvenSimpleGpu in one directory.
+    The values of all sequences are stored contiguously in values.npy (float32, [n, features]) and memory mapped, the
+    values of sequence i are at offsets[i]:offsets[i + 1]. meta.npy holds the start timestamp and the aggregation
+    time of every sequence. Indexing returns [(start, aggr), values] like the pickled list.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+        self.meta = np.load(os.path.join(path, 'meta.npy'))
+
+    def __getitem__(self, i):
+        return [(float(self.meta['start'][i]), int(self.meta['aggr'][i])),
+                self.values[self.offsets[i]:self.offsets[i + 1]]]
+
+    def __len__(self):
+        return len(self.meta)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @staticmethod
+    def write(path: str, sequences: list, dtype=np.float32):
+        os.makedirs(path, exist_ok=True)
+
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x[1]) for x in sequences])
+        meta = np.array([tuple(x[0]) for x in sequences], dtype=META_DTYPE)
+        features = sequences[0][1].reshape(len(sequences[0][1]), -1).shape[1] if sequences else 1
+
+        values = np.lib.format.open_memmap(os.path.join(path, 'values.npy'), mode='w+', dtype=dtype,
+                                           shape=(int(offsets[-1]), features))
+        for i, (_, x) in enumerate(sequences):
+            values[offsets[i]:offsets[i + 1]] = x.reshape(len(x), -1)
+        values.flush()
+
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        np.save(os.path.join(path, 'meta.npy'), meta)
+
+
+def source_version(path: str) -> tuple:
+    """(name, mtime, size) of a processed file or of the files of a store directory. Unlike the mtime of the
+    directory this changes when the files of the store are rewritten in place."""
+    if not os.path.isdir(path):
+        return (os.path.basename(path), os.path.getmtime(path), os.path.getsize(path)),
+
+    files = sorted(f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)))
+    return tuple((f, os.path.getmtime(os.path.join(path, f)), os.path.getsize(os.path.join(path, f))) for f in files)
+
+
+def source_mtime(path: str) -> float:
+    # time of the last change of a processed file or of one of the files of a store directory
+    return max((x[1] for x in source_version(path)), default=os.path.getmtime(path))
+
+
+def is_sequence_store(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, 'values.npy')) and os.path.isfile(os.path.join(path, 'meta.npy'))
+
+
+def load_sequences(path: str):
+    # returns a SequenceStore for sequence store directories and the pickled list otherwise
+    if is_sequence_store(path):
+        print(f"[+] Opening sequence store with location: {path} ...")
+        return SequenceStore(path)
+
+    with open(path, 'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,88 @@
+import os
+import shutil
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d, convolve
+
+from utils.sequence_store import SequenceStore, load_sequences, source_mtime
+from utils.tools import available_cpus, ema_smoothing
+
+SMOOTHING_TRANSFORMS = ['gaussian', 'uniform', 'ema']
+
+
+def smooth_flow(values: np.ndarray, transform: str, smooth_param) -> np.ndarray:
+    # values: 1d float64 series of one flow
+    if transform == 'gaussian':
+        return gaussian_filter1d(values, sigma=smooth_param, mode="nearest")
+
+    if transform == 'uniform':
+        kernel = np.array([1 / smooth_param for _ in range(-((smooth_param - 1) // 2), ((smooth_param - 1) // 2))])
+        return convolve(values, weights=kernel, mode="constant", cval=0.0)
+
+    if transform == 'ema':
+        return ema_smoothing(values, a=smooth_param)
+
+    raise AttributeError(f"Unknown smoothing transform {transform}.")
+
+
+def _smooth_store(path: str, bounds: tuple, transform: str, smooth_param):
+    # smooths the sequences bounds[0]:bounds[1] of the store in place
+    values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r+')
+    offsets = np.load(os.path.join(path, 'offsets.npy'))
+
+    for i in range(*bounds):
+        values[offsets[i]:offsets[i + 1], 0] = smooth_flow(
+            np.array(values[offsets[i]:offsets[i + 1], 0], dtype=np.float64), transform, smooth_param)
+    values.flush()
+
+
+def _chunks(offsets: np.ndarray, count: int) -> list:
+    # consecutive ranges of sequences with about the same number of values
+    borders = np.searchsorted(offsets, np.linspace(0, offsets[-1], count + 1), side='right') - 1
+    borders[-1] = len(offsets) - 1
+    return [(int(b), int(e)) for b, e in zip(borders[:-1], borders[1:]) if e > b]
+
+
+def smoothed_sequences_path(path: str, transform: str, smooth_param) -> str:
+    return f"{os.path.splitext(path.rstrip(os.sep))[0]}_{transform}_{smooth_param}"
+
+
+def smooth_sequences(path: str, transform: str, smooth_param, processes: int = None):
+    """Smoothed processed sequences of path (pickle or sequence store). Every sequence is smoothed on its own in
+    float64 and written back into the concatenated float32 values, spread over processes. The result is kept as
+    sequence store next to path and reused as long as its files are newer than the files of path.
+    """
+    save_path = smoothed_sequences_path(path, transform, smooth_param)
+    if os.path.isdir(save_path) and source_mtime(save_path) >= source_mtime(path):
+        print(f"[+] Opening smoothed sequences with location: {save_path} ...")
+        return SequenceStore(save_path)
+
+    sequences = load_sequences(path)
+    if len(sequences) > 0 and isinstance(sequences[0][0], np.ndarray):  # time marks of every step (older files)
+        return [[stamp, smooth_flow(values.reshape(-1).astype(np.float64), transform,
+                                    smooth_param).astype(np.float32).reshape(-1, 1)] for stamp, values in sequences]
+
+    print(f"[+] Smoothing {len(sequences)} sequences with {transform} {smooth_param} ...")
+    shutil.rmtree(save_path, ignore_errors=True)
+    tmp = f"{save_path}.tmp{os.getpid()}"
+    SequenceStore.write(tmp, sequences)
+
+    offsets = np.load(os.path.join(tmp, 'offsets.npy'))
+    processes = processes or available_cpus()
+    smooth = partial(_smooth_store, tmp, transform=transform, smooth_param=smooth_param)
+    if processes == 1:
+        for bounds in _chunks(offsets, 1):
+            smooth(bounds)
+    else:
+        with Pool(processes) as pool:
+            for _ in pool.imap_unordered(smooth, _chunks(offsets, processes * 4)):
+                pass
+
+    try:
+        os.rename(tmp, save_path)
+        print(f"[+] Saved smoothed sequences in {save_path}.")
+    except OSError:  # written by another job in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+    return SequenceStore(save_path)
@@ -0,0 +1,195 @@
+import os
+import shutil
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.signal import stft
+
+from utils.sequence_store import load_sequences, source_mtime
+from utils.timefeatures import time_marks
+from utils.tools import available_cpus
+
+
+class StftStore:
+    """Processed flows with precomputed STFT frames for the STFT datasets.
+    The base directory holds the values (float32, [n, 1]) and time stamps of every step of all flows, flow i is at
+    offsets[i]:offsets[i + 1]. Every (seg_len, overlap) has a sub directory with the frames (real parts followed by
+    the imaginary parts), the step of every frame and the frequencies, frame_offsets index the frames of the flows.
+    All arrays are memory mapped.
+    """
+
+    def __init__(self, path: str, seg_len: int, overlap: int):
+        self.path = path
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+        self.stamps = np.load(os.path.join(path, 'stamps.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'))
+
+        frames_path = os.path.join(path, stft_frames_dir(seg_len, overlap))
+        self.frames = np.load(os.path.join(frames_path, 'frames.npy'), mmap_mode='r')
+        self.frame_times = np.load(os.path.join(frames_path, 'frame_times.npy'), mmap_mode='r')
+        self.frame_offsets = np.load(os.path.join(frames_path, 'frame_offsets.npy'))
+        self.freqs = np.load(os.path.join(frames_path, 'freqs.npy'))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def flow(self, i: int) -> tuple:
+        # time stamps and values of every step
+        return self.stamps[self.offsets[i]:self.offsets[i + 1]], self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def flow_frames(self, i: int) -> tuple:
+        # frames and the step of every frame
+        s, e = self.frame_offsets[i], self.frame_offsets[i + 1]
+        return self.frames[s:e], self.frame_times[s:e]
+
+
+def stft_frames_dir(seg_len: int, overlap: int) -> str:
+    return f'stft_{seg_len}_{overlap}'
+
+
+def stft_frame_count(length: int, seg_len: int, overlap: int) -> int:
+    # number of frames of scipy.signal.stft with boundary=None and padded=True
+    if length < seg_len:
+        return 0
+    hop = seg_len - overlap
+    return (length - seg_len + (-(length - seg_len) % hop)) // hop + 1
+
+
+def _has_values(sequence) -> bool:
+    # [(start, aggr) or time stamps of every step, values] instead of a list of (time stamp, bytes) steps
+    return len(sequence) == 2 and isinstance(sequence[1], np.ndarray)
+
+
+def _flow_steps(sequence) -> tuple:
+    # time stamps and values of every step of a flow in one of the processed formats
+    if _has_values(sequence):
+        stamps, values = sequence
+        values = values.reshape(-1)
+        if isinstance(stamps, tuple):
+            stamps = time_marks(stamps[0], len(values), stamps[1])
+        return np.asarray(stamps), values
+
+    return np.array([x[0] for x in sequence]), np.array([x[1] for x in sequence], dtype=np.float64)
+
+
+def _write_base(file_path: str, save_path: str):
+    sequences = load_sequences(file_path)
+    steps = [_flow_steps(sequences[0])] if len(sequences) > 0 else []
+
+    offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x[1]) if _has_values(x) else len(x) for x in sequences])
+    stamp_shape = steps[0][0].shape[1:] if steps else ()
+    stamp_dtype = steps[0][0].dtype if steps else np.int64
+
+    tmp = f"{save_path}.tmp{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    values = np.lib.format.open_memmap(os.path.join(tmp, 'values.npy'), mode='w+', dtype=np.float32,
+                                       shape=(int(offsets[-1]), 1))
+    stamps = np.lib.format.open_memmap(os.path.join(tmp, 'stamps.npy'), mode='w+', dtype=stamp_dtype,
+                                       shape=(int(offsets[-1]),) + stamp_shape)
+    for i, sequence in enumerate(sequences):
+        stamps[offsets[i]:offsets[i + 1]], values[offsets[i]:offsets[i + 1], 0] = _flow_steps(sequence)
+    values.flush()
+    stamps.flush()
+    np.save(os.path.join(tmp, 'offsets.npy'), offsets)
+
+    try:
+        os.rename(tmp, save_path)
+    except OSError:  # written by another job in the meantime
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _write_frames(path: str, frames_path: str, bounds: tuple, seg_len: int, overlap: int):
+    # computes the frames of the flows bounds[0]:bounds[1] into the already allocated frame files
+    values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(path, 'offsets.npy'))
+
+    frames = np.load(os.path.join(frames_path, 'frames.npy'), mmap_mode='r+')
+    frame_times = np.load(os.path.join(frames_path, 'frame_times.npy'), mmap_mode='r+')
+    frame_offsets = np.load(os.path.join(frames_path, 'frame_offsets.npy'))
+
+    for i in range(*bounds):
+        s, e = frame_offsets[i], frame_offsets[i + 1]
+        if s == e:
+            continue
+
+        flow = values[offsets[i]:offsets[i + 1], 0].astype(np.float64)
+        _, times, z = stft(flow, nperseg=seg_len, noverlap=overlap, boundary=None)
+        frames[s:e] = np.concatenate((z.real.transpose(), z.imag.transpose()), axis=1)
+        frame_times[s:e] = times.astype(int)
+    frames.flush()
+    frame_times.flush()
+
+
+def write_stft_store(file_path: str, save_path: str, pairs: list, processes: int = None):
+    """Writes the flows of the processed file (pickle or sequence store) and their STFT frames for every
+    (seg_len, overlap) in pairs into the store save_path. Frames that are already in the store are kept as long as
+    the store is newer than the processed file, otherwise the store is rebuilt."""
+    if os.path.isdir(save_path) and os.path.abspath(save_path) != os.path.abspath(file_path) and \
+            source_mtime(save_path) < source_mtime(file_path):
+        print(f"[+] Removing stale stft store {save_path} ...")
+        shutil.rmtree(save_path, ignore_errors=True)
+
+    if not os.path.isdir(save_path):
+        print(f"[+] Writing flows of {file_path} in stft store {save_path} ...")
+        _write_base(file_path, save_path)
+
+    offsets = np.load(os.path.join(save_path, 'offsets.npy'))
+    processes = processes or available_cpus()
+
+    for seg_len, overlap in pairs:
+        frames_path = os.path.join(save_path, stft_frames_dir(seg_len, overlap))
+        if os.path.isdir(frames_path):
+            if source_mtime(frames_path) >= source_mtime(save_path):
+                continue
+            shutil.rmtree(frames_path, ignore_errors=True)  # older than the flows of the store
+
+        print(f"[+] Computing stft frames with seg_len {seg_len} and overlap {overlap} ...")
+        tmp = f"{frames_path}.tmp{os.getpid()}"
+        os.makedirs(tmp, exist_ok=True)
+
+        frame_offsets = np.zeros(len(offsets), dtype=np.int64)
+        frame_offsets[1:] = np.cumsum([stft_frame_count(n, seg_len, overlap) for n in np.diff(offsets).tolist()])
+        freqs = stft(np.zeros(seg_len), nperseg=seg_len, noverlap=overlap, boundary=None)[0]
+
+        np.lib.format.open_memmap(os.path.join(tmp, 'frames.npy'), mode='w+', dtype=np.float32,
+                                  shape=(int(frame_offsets[-1]), 2 * len(freqs))).flush()
+        np.lib.format.open_memmap(os.path.join(tmp, 'frame_times.npy'), mode='w+', dtype=np.int64,
+                                  shape=(int(frame_offsets[-1]),)).flush()
+        np.save(os.path.join(tmp, 'frame_offsets.npy'), frame_offsets)
+        np.save(os.path.join(tmp, 'freqs.npy'), freqs)
+
+        # flows in consecutive ranges with about the same number of frames
+        borders = np.searchsorted(frame_offsets, np.linspace(0, frame_offsets[-1], processes * 4 + 1),
+                                  side='right') - 1
+        borders[-1] = len(frame_offsets) - 1
+        chunks = [(int(b), int(e)) for b, e in zip(borders[:-1], borders[1:]) if e > b]
+
+        write = partial(_write_frames, save_path, tmp, seg_len=seg_len, overlap=overlap)
+        if processes == 1:
+            for bounds in chunks:
+                write(bounds)
+        else:
+            with Pool(processes) as pool:
+                for _ in pool.imap_unordered(write, chunks):
+                    pass
+
+        try:
+            os.rename(tmp, frames_path)
+            print(f"[+] Saved stft frames in {frames_path}.")
+        except OSError:  # written by another job in the meantime
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def is_stft_store(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, 'stamps.npy'))
+
+
+def open_stft_store(path: str, seg_len: int, overlap: int) -> StftStore:
+    # path is a stft store or a processed file whose store is kept next to it and completed if required
+    save_path = path if is_stft_store(path) else f"{os.path.splitext(path.rstrip(os.sep))[0]}_stft"
+    write_stft_store(path, save_path, [(seg_len, overlap)])
+
+    print(f"[+] Opening stft store with location: {save_path} ...")
+    return StftStore(save_path, seg_len, overlap)
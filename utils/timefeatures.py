@@ -1,3 +1,4 @@
+import datetime
 from typing import List
 
 import numpy as np
@@ -132,3 +133,33 @@ def time_features_from_frequency_str(freq_str: str) -> List[TimeFeature]:
 
 def time_features(dates, freq='h'):
     return np.vstack([feat(dates) for feat in time_features_from_frequency_str(freq)])
+
+
+def time_marks(start: float, length: int, aggr: int = 1000, offset: int = 0) -> np.ndarray:
+    """Calendar columns [month, day, weekday, hour, minute, second, millisecond, microsecond] of the steps
+    offset:offset + length with a width of 1 / aggr seconds starting at the unix timestamp start (local time like
+    datetime.fromtimestamp)"""
+    steps = np.arange(offset, offset + length, dtype=np.int64)
+    return calendar_marks(local_datetime64(start) + (steps * 1000000 // aggr).astype('timedelta64[us]'))
+
+
+def local_datetime64(start: float) -> np.datetime64:
+    return np.datetime64(datetime.datetime.fromtimestamp(start), 'us')
+
+
+def calendar_marks(times: np.ndarray) -> np.ndarray:
+    """Calendar columns of time_marks for datetime64[us] times of any shape, added as last dimension"""
+    months = times.astype('datetime64[M]')
+    days = times.astype('datetime64[D]')
+    us = (times - days).astype(np.int64)  # microseconds of the day
+
+    return np.stack([
+        months.astype(np.int64) % 12 + 1,
+        (days - months).astype(np.int64) + 1,
+        (days.astype(np.int64) + 3) % 7,  # 1970-01-01 was a thursday
+        us // 3600000000,
+        us // 60000000 % 60,
+        us // 1000000 % 60,
+        us // 1000 % 1000,
+        us % 1000,
+    ], axis=-1)
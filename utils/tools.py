@@ -1,9 +1,12 @@
 import datetime
+import inspect
 import itertools
+import os
 import random
 
 import numpy as np
 import torch
+from scipy.signal import lfilter
 
 
 # plt.switch_backend('agg')
@@ -73,6 +76,39 @@ class EarlyStopping:
         self.val_loss_min = val_loss
 
 
+def available_cpus() -> int:
+    # cpus the job may use (e.g. its slurm allocation) instead of all cpus of the node like os.cpu_count()
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def save_checkpoint(state: dict, path: str):
+    # written next to path first, so a job that is killed while saving keeps the previous checkpoint
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    torch.save(state, tmp)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path: str, map_location=None) -> dict:
+    # checkpoints also hold the random states, which weights_only (torch >= 1.13) would refuse
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    return torch.load(path, map_location=map_location)
+
+
+def rng_state() -> dict:
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else []}
+
+
+def set_rng_state(state: dict):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
 class dotdict(dict):
     """dot.notation access to dictionary attributes"""
     __getattr__ = dict.get
@@ -81,7 +117,9 @@ class dotdict(dict):
 
 
 def ema_smoothing(data: np.ndarray, a: float = 1) -> np.ndarray:
-    for i in range(1, len(data)):
-        data[i] = a * data[i - 1] + (1 - a) * data[i]
+    # y[0] = x[0], y[i] = a * y[i - 1] + (1 - a) * x[i] along the last axis as IIR filter - data is not changed
+    data = np.asarray(data)
+    if data.shape[-1] == 0:
+        return data.copy()
 
-    return data
+    return lfilter([1 - a], [1, -a], data, axis=-1, zi=a * data[..., :1])[0]